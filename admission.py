@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+"""
+This module sheds load from Item Catalog Application when it is overloaded.
+
+admit hooks into a Flask app and limits how many requests of every class
+(e.g. reads, writes and logins) run at the same time in a process. Requests
+above the budget of their class wait in a bounded queue for a free slot.
+When the queue is full, or a request has waited longer than a timeout, it
+is answered at once with 503 Service Unavailable and a Retry-After header
+instead of piling up on the database, so requests that are admitted keep a
+bounded latency and clients back off.
+
+Requests chosen by a predicate, e.g. those of the JSON APIs, can also be
+rate limited per client with a token bucket: a client gets a burst of
+requests and then a steady number per second, and is answered with 429 Too
+Many Requests and a Retry-After header above that.
+"""
+
+import math
+import threading
+import time
+from collections import OrderedDict
+from flask import g, request
+
+
+class Limiter(object):
+    """
+    Limiter runs at most budget requests at a time and queues a bounded
+    number of others in arrival order.
+    """
+
+    def __init__(self, budget, queueSize, timeout):
+        self.budget = budget
+        self.queueSize = queueSize
+        self.timeout = timeout
+        self.active = 0
+        self.queued = 0
+        self.admitted = 0
+        self.shed = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """
+        acquire waits for a free slot.
+
+        returns:
+        True once the request may run, False if it is shed because the queue
+        is full or the wait timed out.
+        """
+        with self._condition:
+            if self.active < self.budget and not self.queued:
+                self.active += 1
+                self.admitted += 1
+                return True
+            if self.queued >= self.queueSize:
+                self.shed += 1
+                return False
+            self.queued += 1
+            deadline = time.time() + self.timeout
+            try:
+                while self.active >= self.budget:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.shed += 1
+                        # Pass on a wake-up this request may have taken.
+                        self._condition.notify()
+                        return False
+                    self._condition.wait(remaining)
+                self.active += 1
+                self.admitted += 1
+                return True
+            finally:
+                self.queued -= 1
+
+    def release(self):
+        """Free the slot of a finished request."""
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+    @property
+    def stats(self):
+        """Return the limiter counters in easily serializeable format."""
+        return {
+            'budget': self.budget,
+            'maxQueued': self.queueSize,
+            'active': self.active,
+            'queued': self.queued,
+            'admitted': self.admitted,
+            'shed': self.shed
+        }
+
+
+class RateLimiter(object):
+    """RateLimiter keeps a token bucket for every recently seen client."""
+
+    def __init__(self, rate, burst, maxClients=10000):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.maxClients = maxClients
+        self.limited = 0
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, client):
+        """
+        take takes a token from the bucket of a client.
+
+        args:
+        client - key of the client, e.g. its address.
+
+        returns:
+        0 if the client may make the request, or else the number of seconds
+        until it may.
+        """
+        now = time.time()
+        with self._lock:
+            tokens, last = self._buckets.pop(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / self.rate
+                self.limited += 1
+            self._buckets[client] = (tokens, now)
+            # Forget the clients seen least recently; they start with a
+            # full bucket when they come back.
+            while len(self._buckets) > self.maxClients:
+                self._buckets.popitem(last=False)
+            return wait
+
+    @property
+    def stats(self):
+        """Return the rate limiter counters in easily serializeable format."""
+        return {
+            'rate': self.rate,
+            'burst': self.burst,
+            'clients': len(self._buckets),
+            'limited': self.limited
+        }
+
+
+class Admission(object):
+    """Admission holds the limiter of every request class."""
+
+    def __init__(self, budgets, queueSize, timeout, rateLimiter=None):
+        self.limiters = dict((name, Limiter(budget, queueSize, timeout))
+                             for name, budget in budgets.items())
+        self.rateLimiter = rateLimiter
+
+    @property
+    def stats(self):
+        """Return the counters of every limiter."""
+        stats = dict((name, limiter.stats)
+                     for name, limiter in self.limiters.items())
+        if self.rateLimiter is not None:
+            stats['rateLimit'] = self.rateLimiter.stats
+        return stats
+
+
+def admit(app, classify, budgets, queueSize=16, timeout=2.0, retryAfter=1,
+          rate=0, burst=20, rateLimited=None):
+    """
+    admit starts limiting the concurrent requests of app.
+
+    args:
+    app - Flask application.
+    classify - function returning the class of the current request, one of
+               the keys of budgets, or None to let the request through.
+    budgets - dict of the number of requests of every class that may run at
+              the same time.
+    queueSize - most requests of a class waiting for a slot.
+    timeout - seconds a request waits for a slot before it is shed.
+    retryAfter - seconds shed requests are asked to wait before retrying.
+    rate - requests per second allowed per client, 0 for no rate limit.
+    burst - requests a client may make at once before it is rate limited.
+    rateLimited - function returning True for requests that are rate
+                  limited, e.g. those of the JSON APIs. By default all are.
+
+    returns:
+    Admission of the app.
+    """
+    rateLimiter = RateLimiter(rate, burst) if rate > 0 else None
+    admission = Admission(budgets, queueSize, timeout, rateLimiter)
+
+    def reject(message, status, seconds):
+        """Return a plain text error asking the client to retry later."""
+        response = app.response_class(message + '\n', status=status,
+                                      mimetype='text/plain')
+        response.headers['Retry-After'] = str(int(math.ceil(seconds)))
+        return response
+
+    @app.before_request
+    def admitRequest():
+        if rateLimiter is not None and (rateLimited is None or
+                                        rateLimited(request)):
+            wait = rateLimiter.take(request.remote_addr)
+            if wait:
+                return reject('Too many requests.', 429, wait)
+        name = classify(request)
+        if name is None:
+            return None
+        limiter = admission.limiters[name]
+        if not limiter.acquire():
+            return reject('The server is busy, try again later.', 503,
+                          retryAfter)
+        g.admissionLimiter = limiter
+
+    @app.teardown_request
+    def releaseRequest(exception=None):
+        # Streamed responses keep their slot until the stream has been sent.
+        limiter = g.pop('admissionLimiter', None)
+        if limiter is not None:
+            limiter.release()
+
+    return admission
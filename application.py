@@ -7,33 +7,687 @@ integrated third-party authentication. Authenticated users have the ability to
 post, edit and delete their own items.
 """
 
+import os
 import random
 import string
-import httplib2
 import json
+import functools
+import collections
+import hashlib
 import requests
-from sqlalchemy import create_engine, asc
-from sqlalchemy.orm import sessionmaker
-from database_setup import Base, Category, Item, User
+import threading
+import time
+try:
+    import ujson
+except ImportError:
+    ujson = None
+from sqlalchemy import asc, text
+from sqlalchemy.exc import OperationalError, SQLAlchemyError
+from sqlalchemy.orm import Session, sessionmaker, scoped_session, joinedload
+from sqlalchemy.pool import QueuePool
+from database_setup import Category, Item, User, createEngine
+from database_setup import CatalogVersion, GLOBAL_VERSION, bumpCatalogVersion
+from database_setup import CATEGORY_LIST_VERSION
+from database_setup import LatestItem, recordItemAdded, recordItemChanged
+from database_setup import recordItemRemoved
 from flask import Flask, render_template, request, redirect, jsonify, url_for
-from flask import flash, make_response, session as login_session
-from oauth2client.client import flow_from_clientsecrets, FlowExchangeError
+from flask import flash, make_response, g, session as login_session
+from flask import Response, current_app, stream_with_context
+from query_counter import QueryCounter, installQueryCounter
+from fragment_cache import FragmentCacheExtension
+from google_oauth import clientFromEnvironment
+from instrumentation import instrument
+from write_queue import WriteQueue, WriteTimeout
+from compression import compress, representationTags
+from assets import registerAssets
+from admission import admit
 
 
-app = Flask(__name__)
-
-# Get client secrets from the json file
-CLIENT_ID = json.loads(
-    open('client_secrets.json', 'r').read())['web']['client_id']
 APPLICATION_NAME = "Item Catalog Application"
 
 
-# Connect to Database and create database session
-engine = create_engine('sqlite:///itemcatalog.db',
-                       connect_args={'check_same_thread': False})
-Base.metadata.bind = engine
-DBSession = sessionmaker(bind=engine)
-session = DBSession()
+def configFromEnvironment():
+    """
+    configFromEnvironment returns the settings given by CATALOG_* variables.
+
+    returns:
+    dict of Flask config values used by create_app.
+    """
+    env = os.environ.get
+    return {
+        'DATABASE_URL': env('CATALOG_DATABASE_URL',
+                            'sqlite:///itemcatalog.db'),
+        # Connection pool settings. Size the pool to the number of worker
+        # threads so that every thread can hold a connection without waiting.
+        'DB_POOL_SIZE': int(env('CATALOG_DB_POOL_SIZE', 10)),
+        'DB_MAX_OVERFLOW': int(env('CATALOG_DB_MAX_OVERFLOW', 10)),
+        'DB_POOL_TIMEOUT': float(env('CATALOG_DB_POOL_TIMEOUT', 30)),
+        # Serve the read-only GET routes from a separate engine whose
+        # connections cannot write.
+        'READ_ENGINE': env('CATALOG_READ_ENGINE', '0') == '1',
+        # Hand item writes to one writer thread that commits everything
+        # queued up together, instead of one commit per request.
+        'GROUP_COMMIT': env('CATALOG_GROUP_COMMIT', '0') == '1',
+        'GROUP_COMMIT_SIZE': int(env('CATALOG_GROUP_COMMIT_SIZE', 100)),
+        'GROUP_COMMIT_DELAY': float(env('CATALOG_GROUP_COMMIT_DELAY', 0)),
+        # Seconds a request waits for the writer thread before giving up.
+        'GROUP_COMMIT_TIMEOUT': float(env('CATALOG_GROUP_COMMIT_TIMEOUT', 30)),
+        'BATCH_CHUNK_SIZE': int(env('CATALOG_BATCH_CHUNK_SIZE', 0)),
+        'FRAGMENT_CACHE_SIZE': int(env('CATALOG_FRAGMENT_CACHE_SIZE', 256)),
+        # Most user records kept in memory, and seconds until they expire.
+        'USER_CACHE_SIZE': int(env('CATALOG_USER_CACHE_SIZE', 10000)),
+        'USER_CACHE_TTL': float(env('CATALOG_USER_CACHE_TTL', 300)),
+        'METRICS': env('CATALOG_METRICS', '1') == '1',
+        'SLOW_QUERY_SECONDS': float(env('CATALOG_SLOW_QUERY_SECONDS', 0.1)),
+        'COMPRESSION': env('CATALOG_COMPRESSION', '1') == '1',
+        'COMPRESSION_MIN_SIZE': int(env('CATALOG_COMPRESSION_MIN_SIZE', 500)),
+        'COMPRESSION_LEVEL': int(env('CATALOG_COMPRESSION_LEVEL', 6)),
+        'COMPRESSION_CACHE_SIZE': int(
+            env('CATALOG_COMPRESSION_CACHE_SIZE', 256)),
+        # Requests of every class run at the same time per process, requests
+        # waiting for a slot, and seconds they wait before they are shed.
+        'ADMISSION': env('CATALOG_ADMISSION', '0') == '1',
+        'ADMISSION_READ': int(env('CATALOG_ADMISSION_READ', 8)),
+        'ADMISSION_WRITE': int(env('CATALOG_ADMISSION_WRITE', 2)),
+        'ADMISSION_AUTH': int(env('CATALOG_ADMISSION_AUTH', 4)),
+        'ADMISSION_QUEUE': int(env('CATALOG_ADMISSION_QUEUE', 16)),
+        'ADMISSION_TIMEOUT': float(env('CATALOG_ADMISSION_TIMEOUT', 2)),
+        'ADMISSION_RETRY_AFTER': int(env('CATALOG_ADMISSION_RETRY_AFTER', 1)),
+        # Requests per second and burst allowed per client on the JSON APIs,
+        # 0 for no limit.
+        'RATE_LIMIT': float(env('CATALOG_RATE_LIMIT', 0)),
+        'RATE_LIMIT_BURST': int(env('CATALOG_RATE_LIMIT_BURST', 20)),
+        # Google OAuth client secrets, relative to the application folder.
+        'CLIENT_SECRETS': 'client_secrets.json',
+    }
+
+
+class Database(object):
+    """
+    Database creates the engines of the application on first use.
+
+    Engines are created once per process: a worker forked from a process
+    that already used the database creates its own engines instead of
+    sharing the parent's SQLite connections. Functions added to listeners
+    are called with every new engine, e.g. to install statement counters.
+    """
+
+    def __init__(self):
+        self.url = None
+        self.separateReadEngine = False
+        self.options = {}
+        self.listeners = []
+        self._engines = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def configure(self, url, separateReadEngine=False, **options):
+        """
+        configure sets the database the engines connect to.
+
+        args:
+        url - database URL.
+        separateReadEngine - True to create a second, read-only engine for
+                             the read sessions.
+        options - keyword arguments of create_engine.
+        """
+        with self._lock:
+            self.url = url
+            self.separateReadEngine = separateReadEngine
+            self.options = options
+            self._engines = None
+            self._pid = None
+
+    def engines(self):
+        """
+        engines returns the engines of the current process.
+
+        returns:
+        tuple of the read-write engine and the engine of the read sessions,
+        which is the same engine unless a separate one was configured.
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                engine = createEngine(self.url, **self.options)
+                readEngine = engine
+                if self.separateReadEngine:
+                    readEngine = createEngine(self.url, readOnly=True,
+                                              **self.options)
+                for created in set([engine, readEngine]):
+                    for listener in self.listeners:
+                        listener(created)
+                self._engines = (engine, readEngine)
+                self._pid = os.getpid()
+            return self._engines
+
+
+database = Database()
+
+
+class CatalogSession(Session):
+    """CatalogSession uses the engines of the current process."""
+
+    def get_bind(self, mapper=None, clause=None):
+        engine, readEngine = database.engines()
+        return readEngine if self.info.get('readOnly') else engine
+
+
+DBSession = sessionmaker(class_=CatalogSession)
+ReadSession = sessionmaker(class_=CatalogSession, info={'readOnly': True})
+# Every request gets its own sessions, removed again in removeSession.
+session = scoped_session(DBSession)
+readSession = scoped_session(ReadSession)
+
+# Routes as (rule, options, view function), added to the app by create_app.
+ROUTES = []
+
+
+def clientSecretsPath():
+    """Return the path of the app's Google OAuth client secrets file."""
+    return os.path.join(current_app.root_path,
+                        current_app.config['CLIENT_SECRETS'])
+
+
+def clientID():
+    """
+    clientID returns the Google OAuth client ID of the app.
+
+    The client secrets file is only read on the first login, not at start-up.
+
+    returns:
+    client ID from the client secrets file.
+    """
+    extensions = current_app.extensions
+    if 'clientID' not in extensions:
+        with open(clientSecretsPath(), 'r') as secrets:
+            extensions['clientID'] = json.load(secrets)['web']['client_id']
+    return extensions['clientID']
+
+
+def route(rule, **options):
+    """
+    route registers a view function for create_app, like app.route.
+
+    args:
+    rule - URL rule.
+    options - options of add_url_rule, e.g. methods.
+
+    returns:
+    decorator returning the view function unchanged.
+    """
+    def decorator(view):
+        ROUTES.append((rule, options, view))
+        return view
+    return decorator
+
+
+# Page sizes of the keyset paginated items list.
+ITEMS_PAGE_SIZE = 100
+MAX_ITEMS_PAGE_SIZE = 1000
+# Number of rows fetched per round trip by the streaming catalog export.
+EXPORT_BATCH_SIZE = 1000
+# Search results per page, and the last page that can be requested.
+SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE = 50
+# Most operations accepted by one batch write request. BATCH_CHUNK_SIZE is
+# the number of them committed per transaction unless the request asks
+# otherwise (0 commits the whole batch at once).
+MAX_BATCH_OPERATIONS = 10000
+# Item fields a batch operation can set, with their column lengths.
+BATCH_FIELDS = (('name', 80), ('description', 250), ('category', 80))
+# Endpoints that never wait for the database and so are not admission
+# controlled, endpoints of the login flow, which have their own budget, and
+# the JSON APIs, which are rate limited per client.
+UNLIMITED_ENDPOINTS = frozenset(['static', 'aboutApplication', 'showLogin',
+                                 'getStats', 'getMetrics'])
+AUTH_ENDPOINTS = frozenset(['gconnect', 'gdisconnect'])
+JSON_ENDPOINTS = frozenset(['getCategoryList', 'getItemsList',
+                            'searchItemsList', 'exportCatalog', 'batchItems'])
+
+
+def admissionClass(request):
+    """Return the admission class of a request, or None if it has none."""
+    if request.endpoint is None or request.endpoint in UNLIMITED_ENDPOINTS:
+        return None
+    if request.endpoint in AUTH_ENDPOINTS:
+        return 'auth'
+    if request.method in ('GET', 'HEAD'):
+        return 'read'
+    return 'write'
+
+
+def writeTimedOut(error):
+    """Answer a write the writer thread did not finish in time with 503."""
+    response = make_response(
+        'The write did not finish in time and may still be applied.', 503)
+    response.headers['Retry-After'] = '1'
+    return response
+
+
+def removeSession(exception=None):
+    """Close the request's database sessions and return their connections."""
+    session.remove()
+    readSession.remove()
+
+
+def runWrite(mutation):
+    """
+    runWrite applies a mutation and commits it.
+
+    In group commit mode the mutation is queued for the writer thread and
+    runWrite waits for its outcome; otherwise it runs in the request session.
+
+    args:
+    mutation - function taking a database session and returning a plain
+               value. It must not commit, and may be run more than once.
+
+    returns:
+    the return value of the mutation, once it is committed. Exceptions of the
+    mutation or of the commit are raised, and WriteTimeout if the writer
+    thread does not get to it within GROUP_COMMIT_TIMEOUT seconds.
+    """
+    writeQueue = current_app.extensions.get('writeQueue')
+    if writeQueue is not None:
+        return writeQueue.submit(mutation).result(
+            current_app.config['GROUP_COMMIT_TIMEOUT'])
+    try:
+        result = mutation(session)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    return result
+
+
+class CategoryCache(object):
+    """
+    CategoryCache keeps the category list in memory between requests.
+
+    The cache is keyed on the category list version stored in the
+    catalog_version table, which database triggers bump whenever any process
+    adds, renames or removes a category (e.g. importCatalog.py or another
+    server worker). The list is only loaded from the database when that
+    version moved. Hit and miss counters are kept for the stats endpoint.
+    """
+
+    def __init__(self):
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self._categories = None
+        self._lock = threading.Lock()
+
+    def get(self, session, version):
+        """
+        get returns the cached category list, loading it on a miss.
+
+        args:
+        session - database session used to load the categories on a miss.
+        version - current category list version, read before the list.
+
+        returns:
+        list of detached Category objects.
+        """
+        with self._lock:
+            if self._categories is not None and self.version == version:
+                self.hits += 1
+                return self._categories
+            self.misses += 1
+        categories = [Category(id=id, name=name) for id, name in
+                      session.query(Category.id, Category.name).all()]
+        with self._lock:
+            # A list loaded after a later write is only newer than version,
+            # and is replaced once the next read sees that write's version.
+            self._categories = categories
+            self.version = version
+        return categories
+
+    def invalidate(self):
+        """invalidate drops the cached list so the next read reloads it."""
+        with self._lock:
+            self._categories = None
+            self.version = None
+
+    @property
+    def stats(self):
+        """Return the cache counters in easily serializeable format."""
+        return {
+            'version': self.version,
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
+categoryCache = CategoryCache()
+
+
+# User columns kept by the user cache, read without building ORM objects.
+USER_COLUMNS = (User.id, User.name, User.email, User.picture)
+UserRecord = collections.namedtuple(
+    'UserRecord', [column.key for column in USER_COLUMNS])
+
+
+class UserCache(object):
+    """
+    UserCache keeps recently used user records in memory.
+
+    Records can be looked up by id or by email. The cache holds at most size
+    records and evicts the least recently used one. Records expire after ttl
+    seconds, so changes written by another process are picked up eventually.
+    Emails that are not in the database are not cached.
+    """
+
+    def __init__(self, size=10000, ttl=300):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._records = collections.OrderedDict()
+        self._ids = {}
+        self._lock = threading.Lock()
+
+    def get(self, session, userId=None, email=None):
+        """
+        get returns the record of a user, loading it on a miss.
+
+        args:
+        session - database session used to load the user on a miss.
+        userId - id of the user, or None to look the user up by email.
+        email - email address of the user.
+
+        returns:
+        UserRecord, or None if there is no such user.
+        """
+        now = time.time()
+        with self._lock:
+            if userId is None:
+                userId = self._ids.get(email)
+            entry = self._records.pop(userId, None)
+            if entry is not None and entry[0] > now:
+                self._records[userId] = entry
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                self._ids.pop(entry[1].email, None)
+            self.misses += 1
+        query = session.query(*USER_COLUMNS)
+        if userId is not None:
+            query = query.filter(User.id == userId)
+        else:
+            query = query.filter(User.email == email)
+        row = query.first()
+        if row is None:
+            return None
+        record = UserRecord(*row)
+        self.put(record)
+        return record
+
+    def put(self, record):
+        """Store a user record, evicting the least recently used one."""
+        with self._lock:
+            self._records.pop(record.id, None)
+            self._records[record.id] = (time.time() + self.ttl, record)
+            self._ids[record.email] = record.id
+            while len(self._records) > self.size:
+                userId, (expires, evicted) = self._records.popitem(
+                    last=False)
+                if self._ids.get(evicted.email) == userId:
+                    del self._ids[evicted.email]
+
+    def clear(self):
+        """Forget all records."""
+        with self._lock:
+            self._records.clear()
+            self._ids.clear()
+
+    @property
+    def stats(self):
+        """Return the cache counters in easily serializeable format."""
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._records),
+            'maxSize': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hitRatio': float(self.hits) / lookups if lookups else 0.0
+        }
+
+
+userCache = UserCache()
+
+
+# Columns returned by Item.serialize, read without building ORM objects.
+ITEM_COLUMNS = (Item.id, Item.name, Item.description, Item.category_id)
+ITEM_KEYS = tuple(column.key for column in ITEM_COLUMNS)
+
+
+def serializeRows(rows, keys=ITEM_KEYS):
+    """
+    serializeRows turns column tuples into dicts like the serialize property.
+
+    args:
+    rows - iterable of column tuples.
+    keys - names of the columns in the tuples.
+
+    returns:
+    list of dicts.
+    """
+    return [dict(zip(keys, row)) for row in rows]
+
+
+def dumpJSON(data):
+    """
+    dumpJSON encodes data in compact JSON with sorted keys.
+
+    dumpJSON uses ujson when it is installed and the standard library json
+    module otherwise. Both produce the same output for the strings and
+    integers served by the JSON endpoints.
+
+    args:
+    data - dicts, lists, strings and integers to encode.
+
+    returns:
+    JSON string.
+    """
+    if ujson is not None:
+        return ujson.dumps(data, sort_keys=True, ensure_ascii=True,
+                           escape_forward_slashes=False)
+    return json.dumps(data, sort_keys=True, separators=(',', ':'))
+
+
+def jsonResponse(data):
+    """
+    jsonResponse returns data as a JSON response, byte for byte like jsonify.
+
+    The compact output of jsonify is produced with dumpJSON. When jsonify
+    would pretty print, or the app changed the JSON settings, jsonify itself
+    is used.
+
+    args:
+    data - dicts, lists, strings and integers to encode.
+
+    returns:
+    JSON response.
+    """
+    config = current_app.config
+    if (current_app.debug or config['JSONIFY_PRETTYPRINT_REGULAR'] or
+            not config['JSON_SORT_KEYS'] or not config['JSON_AS_ASCII']):
+        return jsonify(data)
+    return current_app.response_class(dumpJSON(data) + '\n',
+                                      mimetype=config['JSONIFY_MIMETYPE'])
+
+
+SEARCH_QUERY = text('''
+    SELECT item.id, item.name, item.description, item.category_id
+    FROM item_fts JOIN item ON item.id = item_fts.rowid
+    WHERE item_fts MATCH :match
+    ORDER BY item_fts.rank
+    LIMIT :limit OFFSET :offset
+''')
+
+
+def searchItems(terms, page):
+    """
+    searchItems finds the items whose name or description match terms.
+
+    Every word of terms must match the start of a word of the item name or
+    description. Results are ranked by relevance (bm25) using the item_fts
+    full-text index.
+
+    args:
+    terms - search terms as typed by the user.
+    page - number of the result page, starting at 1.
+
+    returns:
+    tuple of the list of serialized items and whether there is a next page,
+    or None if the database has no full-text index.
+    """
+    words = terms.split()
+    if not words:
+        return [], False
+    # Quote every word so FTS5 query syntax typed by users is taken literally.
+    match = u' '.join(u'"%s"*' % word.replace(u'"', u'""') for word in words)
+    try:
+        rows = readSession.execute(SEARCH_QUERY, {
+            'match': match, 'limit': SEARCH_PAGE_SIZE + 1,
+            'offset': (page - 1) * SEARCH_PAGE_SIZE}).fetchall()
+    except OperationalError:
+        readSession.rollback()
+        return None
+    items = serializeRows(rows)
+    return items[:SEARCH_PAGE_SIZE], len(items) > SEARCH_PAGE_SIZE
+
+
+def injectCategoryVersion():
+    """
+    injectCategoryVersion makes the category list version a template value.
+
+    The version is the one the request's category list was loaded at, not
+    the current one, so a fragment rendered from an old list is never stored
+    under a newer version.
+    """
+    return {'categoryVersion': g.get('categoryVersion')}
+
+
+def getCategories():
+    """
+    getCategories returns the list of all categories.
+
+    returns:
+    list of Category objects served from the category cache.
+    """
+    g.categoryVersion = categoryListVersion()
+    return categoryCache.get(readSession, g.categoryVersion)
+
+
+def categoryListVersion():
+    """
+    categoryListVersion returns the stored version of the category list.
+
+    It is read at most once per request, and not at all when catalogVersion
+    already read it along with the version of a conditional GET.
+
+    returns:
+    version of the category list.
+    """
+    if 'categoryListVersion' not in g:
+        g.categoryListVersion = readSession.query(
+            CatalogVersion.version).filter(
+            CatalogVersion.id == CATEGORY_LIST_VERSION).scalar() or 0
+    return g.categoryListVersion
+
+
+def catalogVersion(categoryId=GLOBAL_VERSION):
+    """
+    catalogVersion returns the version of the catalog or of one category.
+
+    args:
+    categoryId - id of a Category, or GLOBAL_VERSION for the whole catalog.
+
+    returns:
+    tuple of the version number and the time of the last write.
+    """
+    # Read the category list version in the same query for getCategories.
+    rows = dict((row.id, row) for row in readSession.query(
+        CatalogVersion.id, CatalogVersion.version,
+        CatalogVersion.updated).filter(
+        CatalogVersion.id.in_([categoryId, CATEGORY_LIST_VERSION])))
+    listRow = rows.get(CATEGORY_LIST_VERSION)
+    g.categoryListVersion = listRow.version if listRow is not None else 0
+    row = rows.get(categoryId)
+    return (row.version, row.updated) if row is not None else (0, None)
+
+
+def conditionalResponse(render, categoryId=GLOBAL_VERSION, private=False):
+    """
+    conditionalResponse answers a GET with 304 if the client copy is current.
+
+    The strong ETag is derived from the request path and the catalog version
+    of categoryId, so answering If-None-Match only reads the catalog_version
+    table. render is called to build the full response only when the client
+    copy is missing or stale. Pages that depend on the login session are
+    private: their ETag also covers the logged in user, and they are never
+    answered from If-Modified-Since or while flash messages are pending.
+
+    args:
+    render - function returning the full response.
+    categoryId - id of the Category whose version the response depends on,
+                 or GLOBAL_VERSION.
+    private - True if the response depends on the login session.
+
+    returns:
+    response with ETag and Last-Modified headers.
+    """
+    if private and '_flashes' in login_session:
+        return render()
+    version, updated = catalogVersion(categoryId)
+    tag = u'%s|%s|%s' % (request.full_path, categoryId, version)
+    if private:
+        tag += u'|%s' % login_session.get('user_id')
+    etag = hashlib.sha1(tag.encode('utf-8')).hexdigest()
+    # The client may hold a compressed copy, whose ETag has a suffix.
+    matched = next((candidate for candidate in representationTags(etag)
+                    if candidate in request.if_none_match), None)
+    if matched is not None:
+        response = current_app.response_class(status=304)
+        etag = matched
+    elif (not private and not request.if_none_match and updated and
+          request.if_modified_since and
+          updated < request.if_modified_since):
+        # Last-Modified only has whole seconds, so a copy fetched in the
+        # second of the last write may predate it and is sent again.
+        response = current_app.response_class(status=304)
+    else:
+        response = make_response(render())
+        if response.status_code != 200:
+            return response
+    response.set_etag(etag)
+    if updated is not None and not private:
+        response.last_modified = updated
+    response.cache_control.no_cache = True
+    if private:
+        response.vary.add('Cookie')
+    return response
+
+
+def startQueryCounter():
+    """Count the SQL statements executed while handling this request."""
+    g.queryCounter = QueryCounter().__enter__()
+
+
+def stopQueryCounter(exception=None):
+    """Stop counting once the request has been handled."""
+    counter = g.pop('queryCounter', None)
+    if counter is not None:
+        counter.__exit__(None, None, None)
+
+
+def addQueryCountHeader(response):
+    """Report the request's SQL statement count when enabled."""
+    counter = g.get('queryCounter')
+    if counter is not None and current_app.config.get('SQL_COUNT_HEADER'):
+        response.headers['X-SQL-Statements'] = str(counter.count)
+    return response
 
 
 # User Helper Functions
@@ -53,9 +707,12 @@ def createUser(login_session):
     newUser = User(name=login_session['username'], email=login_session[
                    'email'], picture=login_session['picture'])
     session.add(newUser)
+    session.flush()
+    record = UserRecord(newUser.id, newUser.name, newUser.email,
+                        newUser.picture)
     session.commit()
-    user = session.query(User).filter_by(email=login_session['email']).one()
-    return user.id
+    userCache.put(record)
+    return record.id
 
 
 def getUserID(email):
@@ -63,7 +720,7 @@ def getUserID(email):
     getUserID returns the User ID.
 
     getUserID takes email as parameter and returns the ID of User associated
-    with the email.
+    with the email. Users are served from the user cache.
 
     args:
     email - email address of the user.
@@ -71,14 +728,14 @@ def getUserID(email):
     returns:
     ID of user associated with given email address.
     """
-    user = session.query(User).filter_by(email=email).first()
+    user = userCache.get(session, email=email)
     if not user:
         return None
     return user.id
 
 
 # Create anti-forgery state token
-@app.route('/catalog/login')
+@route('/catalog/login')
 def showLogin():
     """
     showLogin renders the login.html template.
@@ -97,7 +754,7 @@ def showLogin():
     return render_template('login.html', STATE=state)
 
 
-@app.route('/gconnect', methods=['POST'])
+@route('/gconnect', methods=['POST'])
 def gconnect():
     """
     gconnect logs in the user to application.
@@ -117,10 +774,13 @@ def gconnect():
         return response
     # Obtain authorization code
     code = request.data
+    # oauth2client is only needed here, so it is not imported at start-up.
+    from oauth2client.client import flow_from_clientsecrets
+    from oauth2client.client import FlowExchangeError
 
     try:
         # Upgrade the authorization code into a credentials object
-        oauth_flow = flow_from_clientsecrets('client_secrets.json', scope='')
+        oauth_flow = flow_from_clientsecrets(clientSecretsPath(), scope='')
         oauth_flow.redirect_uri = 'postmessage'
         credentials = oauth_flow.step2_exchange(code)
     except FlowExchangeError:
@@ -129,12 +789,17 @@ def gconnect():
         response.headers['Content-Type'] = 'application/json'
         return response
 
-    # Check that the access token is valid.
+    # Check that the access token is valid, fetching the user info at the
+    # same time.
     access_token = credentials.access_token
-    url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?access_token=%s'
-           % access_token)
-    h = httplib2.Http()
-    result = json.loads(h.request(url, 'GET')[1])
+    try:
+        result, data = current_app.extensions[
+            'googleClient'].tokenAndUserInfo(access_token)
+    except requests.RequestException:
+        response = make_response(
+            json.dumps('Failed to verify the access token.'), 500)
+        response.headers['Content-Type'] = 'application/json'
+        return response
 
     # If there was an error in the access token info, abort.
     if result.get('error') is not None:
@@ -151,7 +816,7 @@ def gconnect():
         return response
 
     # Verify that the access token is valid for this app.
-    if result['issued_to'] != CLIENT_ID:
+    if result['issued_to'] != clientID():
         response = make_response(
             json.dumps("Token's client ID does not match app's."), 401)
         print "Token's client ID does not match app's."
@@ -170,13 +835,6 @@ def gconnect():
     login_session['access_token'] = credentials.access_token
     login_session['gplus_id'] = gplus_id
 
-    # Get user info
-    userinfo_url = "https://www.googleapis.com/oauth2/v1/userinfo"
-    params = {'access_token': credentials.access_token, 'alt': 'json'}
-    answer = requests.get(userinfo_url, params=params)
-
-    data = answer.json()
-
     login_session['username'] = data['name']
     login_session['picture'] = data['picture']
     login_session['email'] = data['email']
@@ -204,7 +862,7 @@ def gconnect():
 
 
 # DISCONNECT - Revoke a current user's token and reset their login_session
-@app.route('/gdisconnect')
+@route('/gdisconnect')
 def gdisconnect():
     """
     gdisconnect logs out the user from application.
@@ -226,13 +884,14 @@ def gdisconnect():
     print ('In gdisconnect access token is %s', access_token)
     print ('User name is: ')
     print (login_session['username'])
-    url = 'https://accounts.google.com/o/oauth2/revoke?token=%s' % access_token
-    h = httplib2.Http()
-    result = h.request(url, 'GET')[0]
+    try:
+        status = current_app.extensions['googleClient'].revoke(access_token)
+    except requests.RequestException:
+        status = None
     print ('result is ')
-    print (result)
+    print (status)
 
-    if result['status'] == '200':
+    if status == 200:
         # Reset the user's sesson.
         del login_session['access_token']
         del login_session['gplus_id']
@@ -252,26 +911,33 @@ def gdisconnect():
         return response
 
 
-@app.route('/')
-@app.route('/catalog/')
+@route('/')
+@route('/catalog/')
 def catalogHome():
     """
     catalogHome renders the cataloghome.html template.
 
     catalogHome obtains the list of categories, latestItems added from database.
+    The latest items are read from the latest_item table, which the write
+    routes keep up to date, so the item table is never sorted.
     It then renders cataloghome.html template by passing the parameters
     categories, latestItems and session object.
 
     returns:
     cataloghome.html template
     """
-    categories = session.query(Category).all()
-    latestItems = session.query(Item).order_by(
-        Item.creation_date.desc()).limit(10).all()
-    return render_template('cataloghome.html', categories=categories,
-                           latestItems=latestItems, session=login_session)
+    def render():
+        categories = getCategories()
+        latestItems = readSession.query(LatestItem).options(
+            joinedload(LatestItem.category)).order_by(
+            LatestItem.creation_date.desc()).all()
+        return render_template('cataloghome.html', categories=categories,
+                               latestItems=latestItems, session=login_session)
 
-@app.route('/catalog/about')
+    return conditionalResponse(render, private=True)
+
+
+@route('/catalog/about')
 def aboutApplication():
     """
     aboutApplication renders about.html which describes about the application.
@@ -279,7 +945,7 @@ def aboutApplication():
     return render_template('about.html')
 
 
-@app.route('/catalog/category/<int:category_id>/items')
+@route('/catalog/category/<int:category_id>/items')
 def showItems(category_id):
     """
     showItem renders showitems.html which displays items in a category.
@@ -294,14 +960,21 @@ def showItems(category_id):
     returns:
     showItems.html template which displays list of items in a selected category.
     """
-    categories = session.query(Category).all()
-    category = session.query(Category).filter_by(id=category_id).one()
-    items = session.query(Item).filter_by(category_id=category_id).all()
-    return render_template('showitems.html', categories=categories,
-                           category=category, items=items)
+    def render():
+        categories = getCategories()
+        category = readSession.query(Category).filter_by(
+            id=category_id).one()
+        items = readSession.query(Item).filter_by(
+            category_id=category_id).all()
+        return render_template('showitems.html', categories=categories,
+                               category=category, items=items)
 
+    # The sidebar lists every category, so the page follows the global
+    # version rather than the one of category_id.
+    return conditionalResponse(render, private=True)
 
-@app.route('/catalog/category/<int:category_id>/item/<int:item_id>')
+
+@route('/catalog/category/<int:category_id>/item/<int:item_id>')
 def viewItem(category_id, item_id):
     """
     viewItem displays item information.
@@ -317,12 +990,17 @@ def viewItem(category_id, item_id):
     returns:
     viewitem.html template which displays info about a specific item.
     """
-    item = session.query(Item).filter_by(id=item_id).one()
-    return render_template('viewitem.html', item=item, session=login_session)
+    def render():
+        item = readSession.query(Item).filter_by(id=item_id).one()
+        return render_template('viewitem.html', item=item,
+                               session=login_session)
+
+    # Items can move between categories, so follow the global version.
+    return conditionalResponse(render, private=True)
 
 
-@app.route('/catalog/category/<int:category_id>/item/<int:item_id>/edit',
-           methods=['GET', 'POST'])
+@route('/catalog/category/<int:category_id>/item/<int:item_id>/edit',
+       methods=['GET', 'POST'])
 def editItem(category_id, item_id):
     """
     editItem updates the Item in database.
@@ -344,23 +1022,34 @@ def editItem(category_id, item_id):
     item = session.query(Item).filter_by(id=item_id).one()
     category = session.query(Category).filter_by(id=category_id).one()
     if request.method == 'POST':
-        newCategory = session.query(Category).filter_by(
-            name=request.form['category']).one()
-        item.name = request.form['name']
-        item.description = request.form['description']
-        item.category_id = newCategory.id
-        session.add(item)
-        session.commit()
-        flash('Item %s is successfully updated.' % item.name)
+        name = request.form['name']
+        description = request.form['description']
+        categoryName = request.form['category']
+
+        def updateItem(session):
+            item = session.query(Item).filter_by(id=item_id).one()
+            newCategory = session.query(Category).filter_by(
+                name=categoryName).one()
+            oldCategoryId = item.category_id
+            bumpCatalogVersion(session, [oldCategoryId, newCategory.id])
+            item.name = name
+            item.description = description
+            item.category_id = newCategory.id
+            session.add(item)
+            session.flush()
+            recordItemChanged(session, item, oldCategoryId)
+
+        runWrite(updateItem)
+        flash('Item %s is successfully updated.' % name)
         return redirect(url_for('showItems', category_id=category_id))
     else:
-        categories = session.query(Category).all()
+        categories = getCategories()
         return render_template('edititem.html', item=item,
                                category=category, categories=categories)
 
 
-@app.route('/catalog/category/<int:category_id>/item/<int:item_id>/delete',
-           methods=['GET', 'POST'])
+@route('/catalog/category/<int:category_id>/item/<int:item_id>/delete',
+       methods=['GET', 'POST'])
 def deleteItem(category_id, item_id):
     """
     deleteItem deletes the item from database.
@@ -382,15 +1071,23 @@ def deleteItem(category_id, item_id):
     item = session.query(Item).filter_by(id=item_id).one()
     category = session.query(Category).filter_by(id=category_id).one()
     if request.method == 'POST':
-        session.delete(item)
-        session.commit()
-        flash('Item %s is successfully deleted.' % item.name)
+        name = item.name
+
+        def removeItem(session):
+            item = session.query(Item).filter_by(id=item_id).one()
+            bumpCatalogVersion(session, [item.category_id])
+            session.delete(item)
+            session.flush()
+            recordItemRemoved(session, item)
+
+        runWrite(removeItem)
+        flash('Item %s is successfully deleted.' % name)
         return redirect(url_for('showItems', category_id=category_id))
     else:
         return render_template('deleteitem.html', item=item)
 
 
-@app.route('/catalog/item/new', methods=['GET', 'POST'])
+@route('/catalog/item/new', methods=['GET', 'POST'])
 def newItem():
     """
     newItem adds new Item to the database.
@@ -405,22 +1102,243 @@ def newItem():
     if 'username' not in login_session:
         return redirect('/login')
     if request.method == 'POST':
-        category = session.query(Category).filter_by(
-            name=request.form['category']).one()
-        newItem = Item(name=request.form['name'],
-                       description=request.form['description'],
-                       category_id=category.id,
-                       user_id=getUserID(login_session['email']))
-        session.add(newItem)
-        session.commit()
-        flash('Item %s is successfully added.' % newItem.name)
-        return redirect(url_for('showItems', category_id=category.id))
+        name = request.form['name']
+        description = request.form['description']
+        categoryName = request.form['category']
+        userId = login_session['user_id']
+
+        def addItem(session):
+            category = session.query(Category).filter_by(
+                name=categoryName).one()
+            newItem = Item(name=name, description=description,
+                           category_id=category.id, user_id=userId)
+            session.add(newItem)
+            session.flush()
+            recordItemAdded(session, newItem)
+            bumpCatalogVersion(session, [category.id])
+            return category.id
+
+        categoryId = runWrite(addItem)
+        flash('Item %s is successfully added.' % name)
+        return redirect(url_for('showItems', category_id=categoryId))
     else:
-        categories = session.query(Category).all()
+        categories = getCategories()
         return render_template('newitem.html', categories=categories)
 
 
-@app.route('/catalog/categoryList')
+def jsonMessage(message, status):
+    """Return a JSON encoded message with the given HTTP status."""
+    response = make_response(json.dumps(message), status)
+    response.headers['Content-Type'] = 'application/json'
+    return response
+
+
+def parseItemOperation(operation):
+    """
+    parseItemOperation validates one operation of a batch write request.
+
+    args:
+    operation - dict decoded from the request JSON.
+
+    returns:
+    tuple of the operation kind (create, update or delete), the item id (None
+    for create) and a dict of the fields to set.
+
+    raises:
+    ValueError describing what is wrong with the operation.
+    """
+    if not isinstance(operation, dict):
+        raise ValueError('Operation must be an object.')
+    kind = operation.get('op')
+    if kind not in ('create', 'update', 'delete'):
+        raise ValueError('op must be create, update or delete.')
+    itemId = None
+    if kind != 'create':
+        itemId = operation.get('id')
+        if not isinstance(itemId, (int, long)) or isinstance(itemId, bool):
+            raise ValueError('id must be an integer.')
+    fields = {}
+    if kind != 'delete':
+        for key, length in BATCH_FIELDS:
+            if key not in operation:
+                continue
+            value = operation[key]
+            if not isinstance(value, basestring) or len(value) > length:
+                raise ValueError('%s must be a string of at most %d '
+                                 'characters.' % (key, length))
+            fields[key] = value
+    if 'name' in fields and not fields['name'].strip():
+        raise ValueError('name must not be empty.')
+    if kind == 'create' and not ('name' in fields and 'category' in fields):
+        raise ValueError('create needs a name and a category.')
+    if kind == 'update' and not fields:
+        raise ValueError('update needs a name, description or category.')
+    return kind, itemId, fields
+
+
+def _inBatches(values, size=500):
+    """Split values into lists small enough for one IN clause."""
+    values = list(values)
+    return [values[start:start + size]
+            for start in range(0, len(values), size)]
+
+
+def applyItemOperations(session, operations, userId, categoryIds, offset=0):
+    """
+    applyItemOperations applies batch write operations without committing.
+
+    The items and the item names the operations refer to are loaded with one
+    query each, all changes are flushed together, and the catalog stats and
+    versions are updated like the form routes do. Items can only be updated
+    or deleted by the user who added them, and each item only once per call.
+    Operations that fail validation are skipped; the others are applied.
+
+    args:
+    session - database session. The caller commits.
+    operations - list of operation dicts decoded from the request JSON.
+    userId - ID of the logged in user.
+    categoryIds - dict of category ids by category name.
+    offset - index of the first operation within the whole request.
+
+    returns:
+    list of result dicts with the index, HTTP status and item id or error of
+    every operation.
+    """
+    results = [None] * len(operations)
+    parsed = []
+    for index, operation in enumerate(operations):
+        try:
+            parsed.append((index,) + parseItemOperation(operation))
+        except ValueError as error:
+            results[index] = {'index': offset + index, 'status': 400,
+                              'error': str(error)}
+
+    items = {}
+    takenNames = set()
+    ids = set(itemId for _, _, itemId, _ in parsed if itemId is not None)
+    for batch in _inBatches(ids):
+        items.update((item.id, item) for item in
+                     session.query(Item).filter(Item.id.in_(batch)))
+    names = set(fields['name'] for _, _, _, fields in parsed
+                if 'name' in fields)
+    for batch in _inBatches(names):
+        takenNames.update(name for name, in session.query(Item.name).filter(
+            Item.name.in_(batch)))
+
+    changes = []
+    changedIds = set()
+    for index, kind, itemId, fields in parsed:
+        error = None
+        item = items.get(itemId)
+        categoryId = categoryIds.get(fields.get('category'))
+        name = fields.get('name')
+        if 'category' in fields and categoryId is None:
+            status, error = 404, 'Category %s does not exist.' % (
+                fields['category'])
+        elif kind != 'create' and item is None:
+            status, error = 404, 'Item %d does not exist.' % itemId
+        elif kind != 'create' and item.user_id != userId:
+            status, error = 403, 'Item %d belongs to another user.' % itemId
+        elif itemId in changedIds:
+            status, error = 409, 'Item %d is already changed.' % itemId
+        elif (name is not None and name in takenNames and
+              (item is None or name != item.name)):
+            status, error = 409, 'An item named %s already exists.' % name
+        if error is not None:
+            results[index] = {'index': offset + index, 'status': status,
+                              'error': error}
+            continue
+
+        if name is not None:
+            takenNames.add(name)
+        if kind == 'create':
+            item = Item(name=name, description=fields.get('description', u''),
+                        category_id=categoryId, user_id=userId)
+            session.add(item)
+            changes.append((index, kind, item, None))
+            continue
+        changedIds.add(itemId)
+        oldCategoryId = item.category_id
+        if kind == 'update':
+            if name is not None:
+                item.name = name
+            if 'description' in fields:
+                item.description = fields['description']
+            if categoryId is not None:
+                item.category_id = categoryId
+        else:
+            session.delete(item)
+        changes.append((index, kind, item, oldCategoryId))
+
+    session.flush()
+    touchedCategories = set()
+    for index, kind, item, oldCategoryId in changes:
+        if kind == 'create':
+            recordItemAdded(session, item)
+        elif kind == 'update':
+            recordItemChanged(session, item, oldCategoryId)
+        else:
+            recordItemRemoved(session, item)
+        touchedCategories.update((oldCategoryId, item.category_id))
+        results[index] = {'index': offset + index, 'id': item.id,
+                          'status': 201 if kind == 'create' else 200}
+    if changes:
+        bumpCatalogVersion(session, touchedCategories)
+    return results
+
+
+@route('/catalog/items/batch', methods=['POST'])
+def batchItems():
+    """
+    batchItems creates, updates and deletes many items in one request.
+
+    batchItems takes a JSON list of operations, or an object with the list
+    under operations, e.g. {"op": "create", "name": ..., "description": ...,
+    "category": ...}, {"op": "update", "id": ..., "name": ...} or
+    {"op": "delete", "id": ...}. The whole batch is committed in one
+    transaction, or in transactions of at most chunk operations when the
+    chunk query parameter is given. A chunk that fails to commit is rolled
+    back as a whole and the following chunks are still applied.
+
+    return:
+    per operation results in JSON format, in the order of the operations.
+    """
+    if 'username' not in login_session:
+        return jsonMessage('Current user not connected.', 401)
+    payload = request.get_json(silent=True)
+    operations = payload
+    if isinstance(payload, dict):
+        operations = payload.get('operations')
+    if not isinstance(operations, list):
+        return jsonMessage('Expected a JSON list of operations.', 400)
+    if len(operations) > MAX_BATCH_OPERATIONS:
+        return jsonMessage('At most %d operations are accepted per request.'
+                           % MAX_BATCH_OPERATIONS, 413)
+    chunkSize = request.args.get(
+        'chunk', current_app.config['BATCH_CHUNK_SIZE'], type=int)
+    if chunkSize <= 0:
+        chunkSize = max(1, len(operations))
+
+    categoryIds = dict((category.name, category.id)
+                       for category in getCategories())
+    results = []
+    for start in range(0, len(operations), chunkSize):
+        chunk = operations[start:start + chunkSize]
+        try:
+            results.extend(runWrite(functools.partial(
+                applyItemOperations, operations=chunk,
+                userId=login_session['user_id'], categoryIds=categoryIds,
+                offset=start)))
+        except SQLAlchemyError:
+            results.extend({'index': start + index, 'status': 500,
+                            'error': 'The chunk was rolled back.'}
+                           for index in range(len(chunk)))
+    return jsonResponse({
+        'applied': sum(1 for result in results if result['status'] < 300),
+        'results': results})
+
+
+@route('/catalog/categoryList')
 def getCategoryList():
     """
     getCategoryList returns the list of categories in JSON format.
@@ -431,18 +1349,98 @@ def getCategoryList():
     return:
     Category List in JSON format.
     """
-    categories = session.query(Category).all()
-    return jsonify({'Category':
-                    [category.serialize for category in categories]})
+    def render():
+        categories = getCategories()
+        return jsonResponse({'Category':
+                             [category.serialize for category in categories]})
+
+    return conditionalResponse(render)
+
+
+def searchArguments():
+    """Return the search terms and page number of the current request."""
+    terms = request.args.get('q', u'').strip()
+    page = request.args.get('page', 1, type=int)
+    return terms, max(1, min(page, MAX_SEARCH_PAGE))
+
+
+@route('/catalog/search')
+def searchPage():
+    """
+    searchPage renders search.html which lists the items matching a search.
+
+    searchPage searches item names and descriptions for the terms given in
+    the q query parameter and renders one page of ranked results.
+
+    returns:
+    search.html template.
+    """
+    terms, page = searchArguments()
 
+    def render():
+        results = searchItems(terms, page)
+        items, hasNext = results if results is not None else ([], False)
+        return render_template('search.html', terms=terms, page=page,
+                               items=items, hasNext=hasNext,
+                               available=results is not None)
 
-@app.route('/catalog/category/<string:category_name>/itemsList')
+    return conditionalResponse(render, private=True)
+
+
+@route('/catalog/search.json')
+def searchItemsList():
+    """
+    searchItemsList returns the items matching a search in JSON format.
+
+    return:
+    One page of ranked matching items in JSON format, along with the URL of
+    the next page.
+    """
+    terms, page = searchArguments()
+
+    def render():
+        results = searchItems(terms, page)
+        if results is None:
+            response = make_response(
+                json.dumps('Search is not available.'), 503)
+            response.headers['Content-Type'] = 'application/json'
+            return response
+        items, hasNext = results
+        nextPage = None
+        if hasNext and page < MAX_SEARCH_PAGE:
+            nextPage = url_for('searchItemsList', q=terms, page=page + 1)
+        return jsonResponse({'query': terms, 'page': page, 'item': items,
+                             'next': nextPage})
+
+    return conditionalResponse(render)
+
+
+@route('/catalog/stats')
+def getStats():
+    """
+    getStats returns the application cache statistics in JSON format.
+
+    return:
+    Hit and miss counters of the application caches in JSON format.
+    """
+    stats = {'categoryCache': categoryCache.stats,
+             'fragmentCache': current_app.jinja_env.fragment_cache.stats,
+             'userCache': userCache.stats}
+    for name in ('writeQueue', 'compressionCache', 'admission'):
+        if name in current_app.extensions:
+            stats[name] = current_app.extensions[name].stats
+    return jsonify(stats)
+
+
+@route('/catalog/category/<string:category_name>/itemsList')
 def getItemsList(category_name):
     """
     getItemList returns the Items list of a specific category in JSON Format.
 
     getItemsList obtains items of a specific category from the database and
-    futher returns the same in JSON format.
+    futher returns the same in JSON format. When the after or limit query
+    parameters are given, only one page of at most limit items with an id
+    greater than after is returned, along with the URL of the next page.
 
     args:
     category_name: name of category.
@@ -450,13 +1448,195 @@ def getItemsList(category_name):
     return:
     List of Items of a specific category in JSON format.
     """
-    category = session.query(Category).filter_by(name=category_name).one()
-    items = session.query(Item).filter_by(category_id=category.id).all()
-    return jsonify({'Category': category_name,
-                    'item': [item.serialize for item in items]})
+    category = readSession.query(Category).filter_by(
+        name=category_name).one()
+    after = request.args.get('after', type=int)
+    limit = request.args.get('limit', type=int)
+
+    def render():
+        query = readSession.query(*ITEM_COLUMNS).filter(
+            Item.category_id == category.id)
+        if after is None and limit is None:
+            return jsonResponse({'Category': category_name,
+                                 'item': serializeRows(query)})
+
+        pageSize = max(1, min(limit or ITEMS_PAGE_SIZE, MAX_ITEMS_PAGE_SIZE))
+        if after is not None:
+            query = query.filter(Item.id > after)
+        # Fetch one extra row to find out whether there is a next page.
+        items = serializeRows(query.order_by(Item.id).limit(pageSize + 1))
+        nextPage = None
+        if len(items) > pageSize:
+            items = items[:pageSize]
+            nextPage = url_for('getItemsList', category_name=category_name,
+                               after=items[-1]['id'], limit=pageSize)
+        return jsonResponse({'Category': category_name,
+                             'item': items,
+                             'next': nextPage})
+
+    return conditionalResponse(render, categoryId=category.id)
+
+
+@route('/catalog.json')
+def exportCatalog():
+    """
+    exportCatalog returns every category with its items in JSON format.
+
+    exportCatalog streams the response from a generator. Item columns are
+    fetched without building ORM objects, in batches of EXPORT_BATCH_SIZE rows
+    in category order, and written out as they arrive, so memory use does not
+    depend on the size of the catalog.
+
+    return:
+    streamed JSON document of all categories and their items.
+    """
+    def generate():
+        rows = readSession.query(*ITEM_COLUMNS).order_by(
+            Item.category_id, Item.id).yield_per(EXPORT_BATCH_SIZE)
+        rows = iter(rows)
+        row = next(rows, None)
+        yield '{"Category":['
+        categories = sorted(getCategories(), key=lambda c: c.id)
+        for index, category in enumerate(categories):
+            if index:
+                yield ','
+            yield '{"id":%d,"name":%s,"item":[' % (
+                category.id, dumpJSON(category.name))
+            # Skip items whose category no longer exists.
+            while row is not None and (row.category_id is None or
+                                       row.category_id < category.id):
+                row = next(rows, None)
+            first = True
+            while row is not None and row.category_id == category.id:
+                if not first:
+                    yield ','
+                yield dumpJSON(dict(zip(ITEM_KEYS, row)))
+                first = False
+                row = next(rows, None)
+            yield ']}'
+        yield ']}\n'
+
+    return conditionalResponse(
+        lambda: Response(stream_with_context(generate()),
+                         mimetype='application/json'))
+
+
+def create_app(config=None):
+    """
+    create_app creates and configures the Flask application.
+
+    Creating the app does not touch the database. Every process creates its
+    engines on its first query, so the app can be created before a pre-fork
+    server forks its workers. The schema is created separately by running
+    `python database_setup.py`. The database and the category cache belong
+    to the module, so create one app per process.
+
+    args:
+    config - dict of config values overriding the CATALOG_* environment
+             variables, e.g. {'DATABASE_URL': 'sqlite:///other.db'}.
+
+    returns:
+    Flask application.
+    """
+    app = Flask(__name__)
+    app.config.update(configFromEnvironment())
+    app.config.update(config or {})
+    app.jinja_env.add_extension(FragmentCacheExtension)
+    app.jinja_env.fragment_cache.size = app.config['FRAGMENT_CACHE_SIZE']
+    # Template helpers for the fingerprinted assets written by buildAssets.py.
+    registerAssets(app)
+    # Pooled keep-alive client shared by all requests talking to Google OAuth.
+    app.extensions['googleClient'] = clientFromEnvironment()
+
+    # Pooled connections are handed from thread to thread, but a connection
+    # is only ever used by the one request session that checked it out.
+    database.listeners = [installQueryCounter]
+    database.configure(app.config['DATABASE_URL'],
+                       separateReadEngine=app.config['READ_ENGINE'],
+                       poolclass=QueuePool,
+                       pool_size=app.config['DB_POOL_SIZE'],
+                       max_overflow=app.config['DB_MAX_OVERFLOW'],
+                       pool_timeout=app.config['DB_POOL_TIMEOUT'],
+                       connect_args={'check_same_thread': False})
+    categoryCache.invalidate()
+    userCache.size = app.config['USER_CACHE_SIZE']
+    userCache.ttl = app.config['USER_CACHE_TTL']
+    userCache.clear()
+    if app.config['GROUP_COMMIT']:
+        app.extensions['writeQueue'] = WriteQueue(
+            DBSession, maxBatch=app.config['GROUP_COMMIT_SIZE'],
+            maxDelay=app.config['GROUP_COMMIT_DELAY'])
+        app.register_error_handler(WriteTimeout, writeTimedOut)
+
+    if app.config['METRICS']:
+        metrics = instrument(
+            app, slowQuerySeconds=app.config['SLOW_QUERY_SECONDS'])
+        database.listeners.append(metrics.watchEngine)
+        metrics.addGauge('catalog_category_cache_hits',
+                         'Category cache hits.', lambda: categoryCache.hits)
+        metrics.addGauge('catalog_category_cache_misses',
+                         'Category cache misses.',
+                         lambda: categoryCache.misses)
+        metrics.addGauge('catalog_user_cache_hit_ratio',
+                         'Share of user lookups served from the cache.',
+                         lambda: userCache.stats['hitRatio'])
+        writeQueue = app.extensions.get('writeQueue')
+        if writeQueue is not None:
+            metrics.addGauge('catalog_write_queue_depth',
+                             'Writes waiting for the writer thread.',
+                             lambda: writeQueue.stats['queued'])
+            metrics.addGauge('catalog_write_batches',
+                             'Batches committed by the writer thread.',
+                             lambda: writeQueue.batches)
+    # Hooked in after the metrics so that they count the shed requests too.
+    if app.config['ADMISSION']:
+        writeBudget = app.config['ADMISSION_WRITE']
+        if app.config['GROUP_COMMIT']:
+            # Writes wait for the writer thread rather than for the database,
+            # so let in enough of them to fill a batch.
+            writeBudget = max(writeBudget, app.config['GROUP_COMMIT_SIZE'])
+        admission = admit(
+            app, admissionClass,
+            {'read': app.config['ADMISSION_READ'],
+             'write': writeBudget,
+             'auth': app.config['ADMISSION_AUTH']},
+            queueSize=app.config['ADMISSION_QUEUE'],
+            timeout=app.config['ADMISSION_TIMEOUT'],
+            retryAfter=app.config['ADMISSION_RETRY_AFTER'],
+            rate=app.config['RATE_LIMIT'],
+            burst=app.config['RATE_LIMIT_BURST'],
+            rateLimited=lambda request: request.endpoint in JSON_ENDPOINTS)
+        app.extensions['admission'] = admission
+        if app.config['METRICS']:
+            for name, limiter in sorted(admission.limiters.items()):
+                metrics.addGauge('catalog_admission_%s_queue_depth' % name,
+                                 'Waiting requests of class %s.' % name,
+                                 lambda limiter=limiter: limiter.queued)
+                metrics.addGauge('catalog_admission_%s_shed' % name,
+                                 'Shed requests of class %s.' % name,
+                                 lambda limiter=limiter: limiter.shed)
+            if admission.rateLimiter is not None:
+                metrics.addGauge('catalog_rate_limited',
+                                 'Requests refused by the rate limit.',
+                                 lambda: admission.rateLimiter.limited)
+    if app.config['COMPRESSION']:
+        app.extensions['compressionCache'] = compress(
+            app, minSize=app.config['COMPRESSION_MIN_SIZE'],
+            level=app.config['COMPRESSION_LEVEL'],
+            cacheSize=app.config['COMPRESSION_CACHE_SIZE'])
+
+    app.teardown_appcontext(removeSession)
+    app.context_processor(injectCategoryVersion)
+    app.before_request(startQueryCounter)
+    app.teardown_request(stopQueryCounter)
+    app.after_request(addQueryCountHeader)
+    for rule, options, view in ROUTES:
+        app.add_url_rule(rule, view_func=view, **options)
+    return app
 
 
 if __name__ == '__main__':
+    app = create_app()
     app.secret_key = 'super_secret_key'
     app.debug = True
-    app.run(host='0.0.0.0', port=8000)
+    app.run(host='0.0.0.0', port=8000, threaded=True)
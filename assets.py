@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""
+This module serves the static assets of Item Catalog Application.
+
+buildAssets.py downloads the CSS and JavaScript the templates use from CDNs
+into static/vendor, together with static/styles.css, under file names that
+contain a hash of their content, and records the names in
+static/vendor/manifest.json. registerAssets makes two helpers available to
+the templates:
+
+    asset_url('styles.css') - like url_for('static', filename=...), but
+        returns the URL of the fingerprinted copy when there is one.
+    vendor_assets('css') - list of (url, integrity) of the vendored CSS or
+        JavaScript files, or of their bundle, in load order. Assets that have
+        not been built are loaded from their CDN.
+
+Fingerprinted files never change, so they are served with a one year
+max-age and Cache-Control: immutable.
+"""
+
+import json
+import os
+from flask import request, url_for
+
+
+# Name, kind (css, js or None when not part of the layout), CDN URL and
+# subresource integrity of every vendored asset, in load order.
+VENDOR_ASSETS = [
+    ('bootstrap.min.css', 'css',
+     'https://stackpath.bootstrapcdn.com/bootstrap/4.3.1/css/'
+     'bootstrap.min.css',
+     'sha384-ggOyR0iXCbMQv3Xipma34MD+dH/1fQ78'
+     '4/j6cY/iJTQUOhcWr7x9JvoRxT2MZw1T'),
+    ('open-iconic-bootstrap.min.css', 'css',
+     'https://cdnjs.cloudflare.com/ajax/libs/open-iconic/1.1.1/font/css/'
+     'open-iconic-bootstrap.min.css',
+     None),
+    ('jquery-3.3.1.slim.min.js', 'js',
+     'https://code.jquery.com/jquery-3.3.1.slim.min.js',
+     'sha384-q8i/X+965DzO0rT7abK41JStQIAqVgRV'
+     'zpbzo5smXKp4YfRvH+8abtTE1Pi6jizo'),
+    ('popper.min.js', 'js',
+     'https://cdnjs.cloudflare.com/ajax/libs/popper.js/1.14.7/umd/'
+     'popper.min.js',
+     'sha384-UO2eT0CpHqdSJQ6hJty5KVphtPhzWj9W'
+     'O1clHTMGa3JDZwrnQq4sF86dIHNDz0W1'),
+    ('bootstrap.min.js', 'js',
+     'https://stackpath.bootstrapcdn.com/bootstrap/4.3.1/js/bootstrap.min.js',
+     'sha384-JjSmVgyd0p3pXB1rRibZUAYoIIy6OrQ6'
+     'VrjIEaFf/nJGzIxFDsf4x0xIM+B07jRM'),
+    ('jquery-1.12.4.min.js', None,
+     'https://ajax.googleapis.com/ajax/libs/jquery/1.12.4/jquery.min.js',
+     None),
+]
+
+# Files of the static folder that are fingerprinted as well.
+LOCAL_ASSETS = ['styles.css']
+
+VENDOR_FOLDER = 'vendor'
+MANIFEST_NAME = 'manifest.json'
+
+# Cache lifetime of fingerprinted files: one year.
+IMMUTABLE_MAX_AGE = 31536000
+
+
+def loadManifest(path):
+    """
+    loadManifest reads the manifest written by buildAssets.py.
+
+    args:
+    path - path of manifest.json.
+
+    returns:
+    dict with the fingerprinted file of every asset under files and the
+    fingerprinted bundle of every kind under bundles. Both are empty when
+    the assets have not been built.
+    """
+    manifest = {'files': {}, 'bundles': {}}
+    if os.path.exists(path):
+        with open(path) as source:
+            manifest.update(json.load(source))
+    return manifest
+
+
+def registerAssets(app, manifestPath=None):
+    """
+    registerAssets adds the asset helpers to app.
+
+    args:
+    app - Flask application.
+    manifestPath - path of manifest.json, by default in static/vendor.
+
+    returns:
+    the loaded manifest.
+    """
+    if manifestPath is None:
+        manifestPath = os.path.join(app.static_folder, VENDOR_FOLDER,
+                                    MANIFEST_NAME)
+    manifest = loadManifest(manifestPath)
+    files = manifest['files']
+    fingerprinted = set(files.values()) | set(manifest['bundles'].values())
+    cdn = dict((name, (url, integrity))
+               for name, kind, url, integrity in VENDOR_ASSETS)
+
+    def assetURL(filename, **values):
+        """Return the URL of a static file, fingerprinted if it is built."""
+        if filename in files:
+            return url_for('static', filename=files[filename], **values)
+        if filename in cdn:
+            return cdn[filename][0]
+        return url_for('static', filename=filename, **values)
+
+    def vendorAssets(kind):
+        """Return (url, integrity) of the vendored assets of a kind."""
+        if kind in manifest['bundles']:
+            return [(url_for('static', filename=manifest['bundles'][kind]),
+                     None)]
+        return [(assetURL(name), None) if name in files else (url, integrity)
+                for name, assetKind, url, integrity in VENDOR_ASSETS
+                if assetKind == kind]
+
+    app.jinja_env.globals.update(asset_url=assetURL,
+                                 vendor_assets=vendorAssets)
+
+    @app.after_request
+    def cacheFingerprintedAssets(response):
+        if (request.endpoint == 'static' and
+                response.status_code in (200, 304) and
+                request.view_args.get('filename') in fingerprinted):
+            response.headers['Cache-Control'] = (
+                'public, max-age=%d, immutable' % IMMUTABLE_MAX_AGE)
+            response.headers.pop('Expires', None)
+        return response
+
+    return manifest
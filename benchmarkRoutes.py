@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+"""
+This python script benchmarks the routes of Item Catalog Application.
+
+It drives every read route through the Flask test client, once anonymously
+and once with a logged in user, and reports p50/p95/p99 latency, throughput
+and SQL statement count per route. Results are saved as JSON and can be
+compared with an earlier run.
+
+    python generateCatalog.py --database sqlite:///bench.db
+    python benchmarkRoutes.py --database sqlite:///bench.db \
+        --output after.json --compare before.json
+"""
+
+import argparse
+import json
+import math
+import random
+import sys
+import time
+
+
+def percentile(values, percent):
+    """Return the nearest-rank percentile of a sorted list of values."""
+    index = int(math.ceil(percent / 100.0 * len(values))) - 1
+    return values[max(0, min(index, len(values) - 1))]
+
+
+def benchmarkURLs(seed):
+    """
+    benchmarkURLs picks the URLs of every benchmarked route.
+
+    args:
+    seed - seed used to pick the category and item.
+
+    returns:
+    list of tuples (label, url).
+    """
+    from application import DBSession
+    from database_setup import Category, Item
+    rng = random.Random(seed)
+    session = DBSession()
+    categoryCount = session.query(Category).count()
+    category = session.query(Category).order_by(Category.id).offset(
+        rng.randrange(categoryCount)).first()
+    item = session.query(Item).filter_by(category_id=category.id).first()
+    session.close()
+    urls = [
+        ('catalogHome', '/catalog/'),
+        ('showItems', '/catalog/category/%d/items' % category.id),
+        ('getCategoryList', '/catalog/categoryList'),
+        ('getItemsList', '/catalog/category/%s/itemsList' % category.name),
+        ('getItemsPage',
+         '/catalog/category/%s/itemsList?limit=100' % category.name),
+    ]
+    if item is not None:
+        urls.append(('viewItem', '/catalog/category/%d/item/%d' % (
+            category.id, item.id)))
+    return urls
+
+
+def benchmarkRoute(client, url, requests, warmup):
+    """
+    benchmarkRoute requests url repeatedly and measures every request.
+
+    returns:
+    dict of latency percentiles in milliseconds, throughput and statements.
+    """
+    from query_counter import QueryCounter
+    for _ in range(warmup):
+        client.get(url).get_data()
+    latencies = []
+    statements = 0
+    started = time.time()
+    for _ in range(requests):
+        with QueryCounter() as counter:
+            start = time.time()
+            response = client.get(url)
+            response.get_data()
+            latencies.append((time.time() - start) * 1000.0)
+        if response.status_code != 200:
+            raise RuntimeError('%s returned %d' % (
+                url, response.status_code))
+        statements += counter.count
+    elapsed = time.time() - started
+    latencies.sort()
+    return {
+        'url': url,
+        'requests': requests,
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'throughput_rps': requests / elapsed,
+        'sql_statements': statements / float(requests),
+    }
+
+
+def compare(results, baseline):
+    """Print the change of every route against a baseline run."""
+    print('\n%-28s %10s %10s %10s' % (
+        'change vs baseline', 'p50', 'p95', 'rps'))
+    for label in sorted(results['routes']):
+        before = baseline['routes'].get(label)
+        if before is None:
+            continue
+        after = results['routes'][label]
+        print('%-28s %+9.1f%% %+9.1f%% %+9.1f%%' % tuple(
+            [label] + [100.0 * (after[key] - before[key]) / before[key]
+                       if before[key] else 0.0
+                       for key in ('p50_ms', 'p95_ms', 'throughput_rps')]))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the routes of Item Catalog Application.')
+    parser.add_argument('--database', default='sqlite:///bench.db',
+                        help='database URL (default: %(default)s)')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='measured requests per route')
+    parser.add_argument('--warmup', type=int, default=10,
+                        help='unmeasured requests per route')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='benchmark.json',
+                        help='file to save the results to')
+    parser.add_argument('--compare', help='results of an earlier run')
+    args = parser.parse_args()
+
+    from application import create_app
+    from checkCatalog import testClient
+    app = create_app({'DATABASE_URL': args.database})
+    app.secret_key = 'benchmark_secret_key'
+
+    results = {'database': args.database, 'requests': args.requests,
+               'seed': args.seed, 'created': time.time(), 'routes': {}}
+    print('%-28s %8s %8s %8s %8s %6s' % ('route', 'p50 ms', 'p95 ms',
+                                         'p99 ms', 'rps', 'sql'))
+    for label, url in benchmarkURLs(args.seed):
+        for loggedIn in (False, True):
+            client = testClient(app, loggedIn)
+            name = '%s%s' % (label, ' (logged in)' if loggedIn else '')
+            result = benchmarkRoute(client, url, args.requests, args.warmup)
+            results['routes'][name] = result
+            print('%-28s %8.2f %8.2f %8.2f %8.1f %6.1f' % (
+                name, result['p50_ms'], result['p95_ms'], result['p99_ms'],
+                result['throughput_rps'], result['sql_statements']))
+
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline:
+            compare(results, json.load(baseline))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
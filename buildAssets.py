@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+"""
+This python script vendors the static assets of Item Catalog Application.
+
+It downloads the CSS and JavaScript listed in assets.VENDOR_ASSETS from their
+CDNs, checks their subresource integrity, and writes them to static/vendor
+together with static/styles.css under content hashed file names, e.g.
+bootstrap.min.3f2a9c1e0b.css. Fonts and images referenced by url() in the CSS
+are vendored as well and the references rewritten. The file names are
+recorded in static/vendor/manifest.json, which the asset_url and
+vendor_assets template helpers read at startup.
+
+    python buildAssets.py
+    python buildAssets.py --bundle --minify
+
+With --bundle the layout CSS and JavaScript are concatenated into one file
+each; --minify strips comments and whitespace from the CSS (the vendored
+JavaScript is already minified). Run it again after changing styles.css.
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import requests
+from assets import VENDOR_ASSETS, LOCAL_ASSETS, VENDOR_FOLDER, MANIFEST_NAME
+try:
+    from urllib.parse import urljoin
+except ImportError:
+    from urlparse import urljoin
+
+
+STATIC_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'static')
+
+CSS_URL = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+SOURCE_MAP = re.compile(r'(/\*# sourceMappingURL=[^*]*\*/|'
+                        r'//# sourceMappingURL=\S*)')
+
+
+def fingerprint(name, data):
+    """Return name with a hash of data inserted before the extension."""
+    base, extension = os.path.splitext(name)
+    return '%s.%s%s' % (base, hashlib.sha256(data).hexdigest()[:10],
+                        extension)
+
+
+def checkIntegrity(name, data, integrity):
+    """Raise ValueError if data does not match its subresource integrity."""
+    if integrity is None:
+        return
+    algorithm, expected = integrity.split('-', 1)
+    digest = base64.b64encode(hashlib.new(algorithm, data).digest())
+    if digest.decode('ascii') != expected:
+        raise ValueError('%s does not match its integrity %s' % (name,
+                                                                 integrity))
+
+
+def minifyCSS(css):
+    """
+    minifyCSS removes comments and needless whitespace from a stylesheet.
+
+    Comments starting with /*! (licenses) are kept.
+
+    args:
+    css - stylesheet text.
+
+    returns:
+    minified stylesheet text.
+    """
+    css = re.sub(r'/\*(?!!).*?\*/', '', css, flags=re.S)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{};,>])\s*', r'\1', css)
+    return css.replace(';}', '}').strip()
+
+
+class AssetBuilder(object):
+    """AssetBuilder writes fingerprinted assets and remembers their names."""
+
+    def __init__(self, folder, http):
+        self.folder = folder
+        self.http = http
+        self.files = {}
+
+    def download(self, url):
+        """Return the content at url."""
+        response = self.http.get(url, timeout=30)
+        response.raise_for_status()
+        return response.content
+
+    def write(self, name, data):
+        """Write a fingerprinted copy of data and return its file name."""
+        filename = fingerprint(name, data)
+        with open(os.path.join(self.folder, filename), 'wb') as target:
+            target.write(data)
+        self.files[name] = '%s/%s' % (VENDOR_FOLDER, filename)
+        return filename
+
+    def vendorReferences(self, css, baseURL):
+        """Vendor the files a stylesheet references and point it at them."""
+        def replace(match):
+            reference = match.group(2)
+            if reference.startswith(('data:', '#')):
+                return match.group(0)
+            path = reference.split('#', 1)[0].split('?', 1)[0]
+            suffix = reference[len(path):]
+            name = os.path.basename(path)
+            if name not in self.files:
+                self.write(name, self.download(urljoin(baseURL, path)))
+            return 'url(%s)' % (
+                self.files[name].split('/', 1)[1] + suffix)
+        return CSS_URL.sub(replace, css)
+
+    def build(self, bundle, minify):
+        """
+        build vendors every asset and returns the manifest.
+
+        args:
+        bundle - True to concatenate the layout assets of every kind.
+        minify - True to minify the CSS.
+
+        returns:
+        manifest dict.
+        """
+        contents = {'css': [], 'js': []}
+        for name, kind, url, integrity in VENDOR_ASSETS:
+            data = self.download(url)
+            checkIntegrity(name, data, integrity)
+            text = SOURCE_MAP.sub('', data.decode('utf-8'))
+            if name.endswith('.css'):
+                text = self.vendorReferences(text, url)
+                if minify:
+                    text = minifyCSS(text)
+            data = text.encode('utf-8')
+            self.write(name, data)
+            if kind is not None:
+                contents[kind].append(data)
+            print('vendored %s' % name)
+        for name in LOCAL_ASSETS:
+            with open(os.path.join(STATIC_FOLDER, name), 'rb') as source:
+                data = source.read()
+            if minify and name.endswith('.css'):
+                data = minifyCSS(data.decode('utf-8')).encode('utf-8')
+            self.write(name, data)
+            print('fingerprinted %s' % name)
+
+        bundles = {}
+        if bundle:
+            for kind, parts in sorted(contents.items()):
+                filename = self.write('bundle.%s' % kind,
+                                      b'\n'.join(parts) + b'\n')
+                bundles[kind] = '%s/%s' % (VENDOR_FOLDER, filename)
+                print('bundled %d files into %s' % (len(parts), filename))
+            for kind in bundles:
+                self.files.pop('bundle.%s' % kind)
+        return {'files': self.files, 'bundles': bundles}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Vendor and fingerprint the static assets.')
+    parser.add_argument('--bundle', action='store_true',
+                        help='concatenate the layout CSS and JavaScript')
+    parser.add_argument('--minify', action='store_true',
+                        help='minify the CSS')
+    args = parser.parse_args()
+
+    folder = os.path.join(STATIC_FOLDER, VENDOR_FOLDER)
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    os.makedirs(folder)
+    builder = AssetBuilder(folder, requests.Session())
+    manifest = builder.build(args.bundle, args.minify)
+    with open(os.path.join(folder, MANIFEST_NAME), 'w') as target:
+        json.dump(manifest, target, indent=2, sort_keys=True)
+    print('wrote %s' % os.path.join(folder, MANIFEST_NAME))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,692 @@
+#!/usr/bin/env python
+"""
+This python script runs performance checks against Item Catalog Application.
+
+It builds a scratch database, points the application at it and drives every
+route through the Flask test client.
+
+    python checkCatalog.py queries - fails if the number of SQL statements of
+                                     any route grows with the number of rows.
+    python checkCatalog.py plans   - fails if EXPLAIN QUERY PLAN shows a full
+                                     table scan for any query of any route.
+    python checkCatalog.py import-time - fails if importing the application
+                                     or create_app is slow or creates files.
+    python checkCatalog.py group-commit - fails if the group commit writer
+                                     does not isolate failing writes or
+                                     does not time out.
+    python checkCatalog.py admission - fails if admission control does not
+                                     shed, queue or rate limit as configured.
+    python checkCatalog.py oauth - fails if login and logout against a
+                                     local stub OAuth server do not reuse
+                                     connections, cache tokeninfo or keep
+                                     cookies out of the shared session.
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def setupScratchDatabase(config=None):
+    """
+    setupScratchDatabase creates the application on an empty scratch database.
+
+    args:
+    config - further config values passed to create_app.
+
+    returns:
+    tuple of the scratch directory and the Flask application.
+    """
+    directory = tempfile.mkdtemp(prefix='itemcatalog-check-')
+    from application import create_app, database
+    from database_setup import createSchema
+    config = dict(config or {}, DATABASE_URL='sqlite:///%s' % os.path.join(
+        directory, 'itemcatalog.db'))
+    app = create_app(config)
+    app.secret_key = 'check_secret_key'
+    createSchema(database.engines()[0])
+    return directory, app
+
+
+def addRows(app, categories, itemsPerCategory):
+    """
+    addRows adds categories and items to the scratch database.
+
+    args:
+    app - Flask application.
+    categories - number of categories to add.
+    itemsPerCategory - number of items to add to every category.
+    """
+    from application import DBSession
+    from database_setup import Category, Item, User, repairCatalogStats
+    session = DBSession()
+    user = session.query(User).filter_by(email='check@example.com').first()
+    if user is None:
+        user = User(name='Check', email='check@example.com')
+        session.add(user)
+    offset = session.query(Category).count()
+    for c in range(offset, offset + categories):
+        session.add(Category(name='Category %d' % c))
+    session.flush()
+    for category in session.query(Category).all():
+        existing = session.query(Item).filter_by(
+            category_id=category.id).count()
+        for i in range(existing, existing + itemsPerCategory):
+            session.add(Item(name='%s item %d' % (category.name, i),
+                             description='Description %d' % i,
+                             category=category, user=user))
+    session.flush()
+    repairCatalogStats(session)
+    session.commit()
+    session.close()
+
+
+def testClient(app, loggedIn):
+    """
+    testClient returns a Flask test client, optionally with a logged in user.
+
+    args:
+    app - Flask application.
+    loggedIn - True to store the check user in the login session.
+
+    returns:
+    Flask test client.
+    """
+    client = app.test_client()
+    if loggedIn:
+        with client.session_transaction() as login_session:
+            login_session['username'] = 'Check'
+            login_session['email'] = 'check@example.com'
+            login_session['picture'] = ''
+            login_session['user_id'] = 1
+    return client
+
+
+def routeURLs(app):
+    """
+    routeURLs returns the URLs of the routes that read from the database.
+
+    args:
+    app - Flask application.
+
+    returns:
+    list of tuples (label, url, logged in).
+    """
+    from application import DBSession
+    from database_setup import Category, Item
+    session = DBSession()
+    category = session.query(Category).order_by(Category.id).first()
+    item = session.query(Item).filter_by(category_id=category.id).first()
+    session.close()
+    itemPath = '/catalog/category/%d/item/%d' % (category.id, item.id)
+    return [
+        ('catalogHome', '/catalog/', False),
+        ('showItems', '/catalog/category/%d/items' % category.id, False),
+        ('viewItem', itemPath, False),
+        ('editItem', itemPath + '/edit', True),
+        ('deleteItem', itemPath + '/delete', True),
+        ('newItem', '/catalog/item/new', True),
+        ('getCategoryList', '/catalog/categoryList', False),
+        ('getItemsList',
+         '/catalog/category/%s/itemsList' % category.name, False),
+        ('getItemsPage',
+         '/catalog/category/%s/itemsList?limit=2' % category.name, False),
+        ('exportCatalog', '/catalog.json', False),
+        ('searchPage', '/catalog/search?q=item', False),
+        ('searchItemsList', '/catalog/search.json?q=item', False),
+    ]
+
+
+def measureQueries(app):
+    """
+    measureQueries returns the SQL statement count of every route.
+
+    args:
+    app - Flask application.
+
+    returns:
+    dict mapping route label to statement count.
+    """
+    from query_counter import QueryCounter
+    counts = {}
+    for label, url, loggedIn in routeURLs(app):
+        client = testClient(app, loggedIn)
+        # Warm the in-process caches so only steady state is measured.
+        client.get(url)
+        with QueryCounter() as counter:
+            response = client.get(url)
+            # Streamed responses only run their queries when read.
+            response.get_data()
+        if response.status_code != 200:
+            raise RuntimeError('%s returned %d' % (url, response.status_code))
+        counts[label] = counter.count
+    return counts
+
+
+# Tables that are read in full on purpose, e.g. the cached category list.
+FULL_SCAN_ALLOWED = set(['category'])
+
+
+def fullScans(statement, parameters):
+    """
+    fullScans returns the tables a statement reads with a full table scan.
+
+    args:
+    statement - SQL statement as sent to the database.
+    parameters - parameters of the statement.
+
+    returns:
+    list of EXPLAIN QUERY PLAN details that are full table scans.
+    """
+    from application import database
+    from database_setup import Base
+    connection = database.engines()[0].raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+        details = [row[-1] for row in cursor.fetchall()]
+    finally:
+        connection.close()
+    scans = []
+    for detail in details:
+        words = detail.split()
+        if not words or words[0] != 'SCAN' or 'USING' in words:
+            continue
+        # Older SQLite versions print "SCAN TABLE item AS item_1".
+        table = words[2] if words[1] == 'TABLE' else words[1]
+        table = table.rstrip('_0123456789')
+        if (table in Base.metadata.tables and
+                table not in FULL_SCAN_ALLOWED):
+            scans.append(detail)
+    return scans
+
+
+def checkPlans(args):
+    """
+    checkPlans verifies that no route query falls back to a full table scan.
+
+    returns:
+    process exit status.
+    """
+    from application import getUserID
+    from query_counter import QueryCounter
+    directory, app = setupScratchDatabase()
+    failed = False
+    try:
+        addRows(app, args.categories, args.items)
+        for label, url, loggedIn in routeURLs(app):
+            client = testClient(app, loggedIn)
+            with QueryCounter() as counter:
+                client.get(url).get_data()
+            for statement, parameters in counter.statements:
+                if not statement.lstrip().upper().startswith('SELECT'):
+                    continue
+                scans = fullScans(statement, parameters)
+                if scans:
+                    failed = True
+                    print('FAIL %s: %s\n    %s' % (
+                        label, '; '.join(scans),
+                        ' '.join(statement.split())))
+            print('%-16s checked %d statements' % (label, counter.count))
+        with QueryCounter() as counter:
+            getUserID('check@example.com')
+        for statement, parameters in counter.statements:
+            scans = fullScans(statement, parameters)
+            if scans:
+                failed = True
+                print('FAIL getUserID: %s' % '; '.join(scans))
+        print('%-16s checked %d statements' % ('getUserID', counter.count))
+    finally:
+        shutil.rmtree(directory)
+    return 1 if failed else 0
+
+
+def checkQueries(args):
+    """
+    checkQueries verifies that route query counts do not depend on row count.
+
+    returns:
+    process exit status.
+    """
+    directory, app = setupScratchDatabase()
+    try:
+        addRows(app, args.categories, args.items)
+        small = measureQueries(app)
+        addRows(app, args.categories * 10, args.items * 10)
+        large = measureQueries(app)
+    finally:
+        shutil.rmtree(directory)
+    failed = False
+    for label in sorted(small):
+        status = 'ok'
+        if small[label] != large[label]:
+            status = 'FAIL'
+            failed = True
+        print('%-16s %3d %3d  %s' % (label, small[label], large[label],
+                                     status))
+    return 1 if failed else 0
+
+
+def checkImportTime(args):
+    """
+    checkImportTime verifies that importing and creating the app is cheap.
+
+    Every run imports application and calls create_app in a new interpreter
+    whose working directory is an empty scratch directory. Both must stay
+    within their budget, and neither may create files, e.g. a database.
+
+    returns:
+    process exit status.
+    """
+    directory = tempfile.mkdtemp(prefix='itemcatalog-import-')
+    here = os.path.dirname(os.path.abspath(__file__))
+    script = ('import time; start = time.time(); import application; '
+              'imported = time.time(); application.create_app(); '
+              'print("%f %f" % (imported - start, time.time() - imported))')
+    env = dict(os.environ)
+    env.pop('CATALOG_DATABASE_URL', None)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [here] + [path for path in [env.get('PYTHONPATH')] if path])
+    try:
+        timings = []
+        for _ in range(args.runs):
+            output = subprocess.check_output([sys.executable, '-c', script],
+                                             cwd=directory, env=env)
+            timings.append([float(value) for value in output.split()])
+        created = sorted(os.listdir(directory))
+    finally:
+        shutil.rmtree(directory)
+    importTime = min(timing[0] for timing in timings)
+    createTime = min(timing[1] for timing in timings)
+    failed = False
+    for label, seconds, budget in (('import application', importTime,
+                                    args.import_budget),
+                                   ('create_app', createTime,
+                                    args.create_budget)):
+        status = 'ok'
+        if seconds > budget:
+            status = 'FAIL'
+            failed = True
+        print('%-20s %6.3fs  budget %6.3fs  %s' % (label, seconds, budget,
+                                                   status))
+    if created:
+        failed = True
+        print('FAIL import created %s' % ', '.join(created))
+    return 1 if failed else 0
+
+
+def report(label, passed):
+    """Print the outcome of one check and return True if it failed."""
+    print('%-48s %s' % (label, 'ok' if passed else 'FAIL'))
+    return not passed
+
+
+def checkGroupCommit(args):
+    """
+    checkGroupCommit verifies the group commit writer of write_queue.py.
+
+    The writer is held up by a mutation waiting on an event while the
+    mutations under test queue up, so they are committed as one batch.
+
+    returns:
+    process exit status.
+    """
+    import threading
+    from application import DBSession
+    from database_setup import Item
+    from write_queue import WriteTimeout
+    directory, app = setupScratchDatabase({'GROUP_COMMIT': True})
+    writeQueue = app.extensions['writeQueue']
+    failed = False
+
+    def addItem(name):
+        def mutation(session):
+            item = Item(name=name, description='', category_id=1)
+            session.add(item)
+            session.flush()
+            return item.id
+        return mutation
+
+    def fail(session):
+        session.add(Item(name='failed', description='', category_id=1))
+        session.flush()
+        raise ValueError('rejected')
+
+    def holdWriter():
+        release = threading.Event()
+        writeQueue.submit(lambda session: release.wait(10))
+        while writeQueue.stats['queued']:
+            time.sleep(0.01)
+        return release
+
+    try:
+        addRows(app, 1, 0)
+        release = holdWriter()
+        batches = writeQueue.batches
+        futures = [writeQueue.submit(addItem('good %d' % i))
+                   for i in range(3)]
+        failing = writeQueue.submit(fail)
+        futures += [writeQueue.submit(addItem('good %d' % i))
+                    for i in range(3, 6)]
+        release.set()
+        ids = [future.result(10) for future in futures]
+        try:
+            failing.result(10)
+            error = None
+        except ValueError as raised:
+            error = raised
+        session = DBSession()
+        names = sorted(name for name, in session.query(Item.name))
+        session.close()
+        failed |= report('failing write gets its own exception',
+                         error is not None)
+        failed |= report('other writes of the batch are committed',
+                         len(set(ids)) == 6 and
+                         names == ['good %d' % i for i in range(6)])
+        failed |= report('batch committed with one commit',
+                         writeQueue.batches - batches == 2)
+
+        release = holdWriter()
+        future = writeQueue.submit(addItem('late'))
+        try:
+            future.result(0.1)
+            timedOut = False
+        except WriteTimeout:
+            timedOut = True
+        release.set()
+        failed |= report('waiting for a held up writer times out', timedOut)
+        failed |= report('timed out write is still committed',
+                         future.result(10) is not None)
+    finally:
+        writeQueue.stop()
+        shutil.rmtree(directory)
+    return 1 if failed else 0
+
+
+def checkAdmission(args):
+    """
+    checkAdmission verifies the admission control of admission.py.
+
+    returns:
+    process exit status.
+    """
+    import threading
+    from admission import Limiter
+    failed = False
+
+    # A request that times out in the queue must not keep the slot, or its
+    # wake-up, from the request queued behind it.
+    limiter = Limiter(1, 2, 0.3)
+    limiter.acquire()
+    outcomes = {}
+
+    def wait(name):
+        start = time.time()
+        outcomes[name] = (limiter.acquire(), time.time() - start)
+
+    first = threading.Thread(target=wait, args=('first',))
+    first.start()
+    time.sleep(0.2)
+    second = threading.Thread(target=wait, args=('second',))
+    second.start()
+    first.join()
+    limiter.release()
+    second.join()
+    failed |= report('queued request times out',
+                     not outcomes['first'][0] and limiter.shed == 1)
+    failed |= report('next queued request gets the freed slot',
+                     outcomes['second'][0] and outcomes['second'][1] < 0.25)
+    limiter.release()
+
+    directory, app = setupScratchDatabase({
+        'ADMISSION': True, 'ADMISSION_READ': 1, 'ADMISSION_QUEUE': 1,
+        'ADMISSION_TIMEOUT': 5, 'RATE_LIMIT': 1, 'RATE_LIMIT_BURST': 2,
+        'GROUP_COMMIT': True})
+    admission = app.extensions['admission']
+    writeQueue = app.extensions['writeQueue']
+    try:
+        addRows(app, 1, 1)
+        read = admission.limiters['read']
+        read.acquire()
+        statuses = []
+        queued = threading.Thread(target=lambda: statuses.append(
+            app.test_client().get('/catalog/').status_code))
+        queued.start()
+        while not read.queued:
+            time.sleep(0.01)
+        response = app.test_client().get('/catalog/category/1/items')
+        failed |= report('full queue answers 503 with Retry-After',
+                         response.status_code == 503 and
+                         'Retry-After' in response.headers)
+        read.release()
+        queued.join()
+        failed |= report('queued request is served', statuses == [200])
+
+        client = app.test_client()
+        statuses = [client.get('/catalog/categoryList').status_code
+                    for _ in range(3)]
+        response = client.get('/catalog/categoryList')
+        failed |= report('rate limit answers 429 after the burst',
+                         statuses == [200, 200, 429] and
+                         response.status_code == 429 and
+                         int(response.headers['Retry-After']) >= 1)
+        failed |= report('rate limit only applies to the JSON APIs',
+                         client.get('/catalog/').status_code == 200)
+
+        # Concurrent writes beyond ADMISSION_WRITE must all reach the writer
+        # thread, so they are committed as one batch.
+        release = threading.Event()
+        writeQueue.submit(lambda session: release.wait(10))
+        while writeQueue.stats['queued']:
+            time.sleep(0.01)
+        batches = writeQueue.batches
+        statuses = []
+
+        def post(index):
+            statuses.append(testClient(app, True).post(
+                '/catalog/item/new', data={
+                    'name': 'queued %d' % index, 'description': '',
+                    'category': 'Category 0'}).status_code)
+        writers = [threading.Thread(target=post, args=(index,))
+                   for index in range(10)]
+        for writer in writers:
+            writer.start()
+        deadline = time.time() + 10
+        while writeQueue.stats['queued'] < 10 and time.time() < deadline:
+            time.sleep(0.01)
+        release.set()
+        for writer in writers:
+            writer.join()
+        failed |= report('group commit batches more than the write budget',
+                         statuses == [302] * 10 and
+                         writeQueue.batches - batches == 2)
+    finally:
+        writeQueue.stop()
+        shutil.rmtree(directory)
+    return 1 if failed else 0
+
+
+def startOAuthStub():
+    """
+    startOAuthStub serves stub Google OAuth endpoints on a local port.
+
+    The token endpoint hands out the same access token on every code
+    exchange. Every response sets a cookie, and every request is recorded
+    with its path, client port and Cookie header.
+
+    returns:
+    tuple of the server and the list of (path, port, cookie) requests.
+    """
+    import base64
+    import json
+    import threading
+    try:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        from socketserver import ThreadingMixIn
+    except ImportError:
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        from SocketServer import ThreadingMixIn
+    requests = []
+    claims = base64.urlsafe_b64encode(
+        json.dumps({'sub': 'check-user'}).encode('utf-8')).rstrip(b'=')
+    idToken = (b'e30.' + claims + b'.c2ln').decode('ascii')
+    bodies = {
+        '/token': {'access_token': 'check-token', 'token_type': 'Bearer',
+                   'expires_in': 3600, 'id_token': idToken},
+        '/tokeninfo': {'user_id': 'check-user', 'issued_to': 'check-client',
+                       'expires_in': 3600},
+        '/userinfo': {'name': 'OAuth Check', 'email': 'oauth@example.com',
+                      'picture': 'http://example.com/oauth.png'},
+        '/revoke': {},
+    }
+
+    class StubHandler(BaseHTTPRequestHandler):
+        # Keep connections open so clients can reuse them.
+        protocol_version = 'HTTP/1.1'
+
+        def respond(self):
+            path = self.path.split('?')[0]
+            length = int(self.headers.get('Content-Length') or 0)
+            if length:
+                self.rfile.read(length)
+            requests.append((path, self.client_address[1],
+                             self.headers.get('Cookie')))
+            body = json.dumps(bodies.get(path, {})).encode('utf-8')
+            self.send_response(200 if path in bodies else 404)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('Set-Cookie', 'stub=%d; Path=/' % len(requests))
+            self.end_headers()
+            self.wfile.write(body)
+
+        do_GET = do_POST = respond
+
+        def log_message(self, format, *args):
+            pass
+
+    class StubServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    server = StubServer(('127.0.0.1', 0), StubHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, requests
+
+
+def checkOAuth(args):
+    """
+    checkOAuth logs in and out against a local stub OAuth server.
+
+    returns:
+    process exit status.
+    """
+    import json
+    server, stubRequests = startOAuthStub()
+    stub = 'http://127.0.0.1:%d' % server.server_address[1]
+    for name in ('TOKENINFO', 'USERINFO', 'REVOKE'):
+        os.environ['CATALOG_GOOGLE_%s_URL' % name] = '%s/%s' % (
+            stub, name.lower())
+    directory, app = setupScratchDatabase()
+    secrets = os.path.join(directory, 'client_secrets.json')
+    with open(secrets, 'w') as secretsFile:
+        json.dump({'web': {
+            'client_id': 'check-client', 'client_secret': 'check-secret',
+            'auth_uri': stub + '/auth', 'token_uri': stub + '/token',
+            'redirect_uris': [], 'javascript_origins': []}}, secretsFile)
+    app.config['CLIENT_SECRETS'] = secrets
+    googleClient = app.extensions['googleClient']
+    failed = False
+
+    def login(client):
+        client.get('/catalog/login')
+        with client.session_transaction() as login_session:
+            state = login_session['state']
+        return client.post('/gconnect?state=%s' % state, data='check-code')
+
+    def calls(path):
+        return [port for called, port, cookie in stubRequests
+                if called == path]
+
+    try:
+        client = app.test_client()
+        response = login(client)
+        with client.session_transaction() as login_session:
+            email = login_session.get('email')
+        failed |= report('login succeeds',
+                         response.status_code == 200 and
+                         email == 'oauth@example.com')
+        failed |= report('tokeninfo and userinfo are fetched once',
+                         len(calls('/tokeninfo')) == 1 and
+                         len(calls('/userinfo')) == 1)
+
+        response = login(app.test_client())
+        failed |= report('second login uses the cached tokeninfo',
+                         response.status_code == 200 and
+                         len(calls('/tokeninfo')) == 1 and
+                         len(calls('/userinfo')) == 2)
+
+        response = client.get('/gdisconnect')
+        with client.session_transaction() as login_session:
+            loggedOut = 'access_token' not in login_session
+        failed |= report('logout revokes the token',
+                         response.status_code == 302 and loggedOut and
+                         len(calls('/revoke')) == 1)
+
+        # tokeninfo and userinfo of the first login run at the same time, so
+        # at most two connections are needed for all calls.
+        ports = set(calls('/tokeninfo') + calls('/userinfo') +
+                    calls('/revoke'))
+        failed |= report('calls reuse pooled connections', len(ports) <= 2)
+        googleCookies = [cookie for path, port, cookie in stubRequests
+                         if path != '/token' and cookie]
+        failed |= report('shared session keeps no cookies',
+                         not googleCookies and
+                         not len(googleClient.http.cookies))
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(directory)
+    return 1 if failed else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    commands = parser.add_subparsers(dest='command')
+    queries = commands.add_parser(
+        'queries', help='check that query counts stay constant')
+    queries.add_argument('--categories', type=int, default=3)
+    queries.add_argument('--items', type=int, default=3)
+    queries.set_defaults(func=checkQueries)
+    plans = commands.add_parser(
+        'plans', help='check that no route query does a full table scan')
+    plans.add_argument('--categories', type=int, default=3)
+    plans.add_argument('--items', type=int, default=3)
+    plans.set_defaults(func=checkPlans)
+    importTime = commands.add_parser(
+        'import-time', help='check that importing the app stays cheap')
+    importTime.add_argument('--runs', type=int, default=5)
+    importTime.add_argument('--import-budget', type=float, default=1.0,
+                            help='seconds (default: %(default)s)')
+    importTime.add_argument('--create-budget', type=float, default=0.2,
+                            help='seconds (default: %(default)s)')
+    importTime.set_defaults(func=checkImportTime)
+    groupCommit = commands.add_parser(
+        'group-commit', help='check the group commit writer')
+    groupCommit.set_defaults(func=checkGroupCommit)
+    admission = commands.add_parser(
+        'admission', help='check admission control and rate limiting')
+    admission.set_defaults(func=checkAdmission)
+    oauth = commands.add_parser(
+        'oauth', help='check login and logout against a stub OAuth server')
+    oauth.set_defaults(func=checkOAuth)
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+"""
+This module compresses the responses of Item Catalog Application.
+
+compress hooks into a Flask app and gzip compresses, or brotli compresses when
+the brotli package is installed and the client prefers it, every HTML, JSON
+and other text response above a size threshold whose client sends a matching
+Accept-Encoding header.
+
+Compressed bodies of responses with an ETag are kept in an LRU cache keyed on
+the ETag and the encoding, so an unchanged resource is compressed once per
+version rather than once per request. The ETag of a compressed response gets
+the encoding as a suffix, e.g. "<etag>-gzip", as a strong ETag must differ
+between representations; representationTags lists the ETags a client may
+send back for a resource.
+
+Streamed responses, e.g. the full catalog dump at /catalog.json, are gzip
+compressed chunk by chunk as they are sent, whatever their size, so they are
+never held in memory. Files sent by send_file are left alone.
+"""
+
+import gzip
+import io
+import zlib
+from flask import request
+from fragment_cache import FragmentCache
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Encodings in order of preference.
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+COMPRESSIBLE_MIMETYPES = set([
+    'text/html', 'text/plain', 'text/css', 'text/javascript',
+    'application/json', 'application/javascript', 'image/svg+xml',
+])
+
+
+def representationTags(etag):
+    """
+    representationTags returns the ETags of every encoding of a response.
+
+    args:
+    etag - ETag of the uncompressed response.
+
+    returns:
+    list of the ETags the response may have been sent with.
+    """
+    return [etag] + ['%s-%s' % (etag, encoding) for encoding in ENCODINGS]
+
+
+def compressBody(data, encoding, level):
+    """
+    compressBody compresses a response body.
+
+    args:
+    data - body bytes.
+    encoding - gzip or br.
+    level - compression level from 1 (fast) to 9 (small).
+
+    returns:
+    compressed bytes.
+    """
+    if encoding == 'br':
+        return brotli.compress(data, quality=min(11, level + 2))
+    buffer = io.BytesIO()
+    # A fixed mtime keeps the output the same for the same body.
+    with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=level,
+                       mtime=0) as body:
+        body.write(data)
+    return buffer.getvalue()
+
+
+def compressStream(chunks, level):
+    """
+    compressStream gzip compresses a streamed response body.
+
+    args:
+    chunks - iterable of body bytes.
+    level - compression level from 1 (fast) to 9 (small).
+
+    returns:
+    generator of gzip compressed bytes.
+    """
+    # wbits 31 writes a gzip header and trailer around the deflate stream.
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    try:
+        for chunk in chunks:
+            if not isinstance(chunk, bytes):
+                chunk = chunk.encode('utf-8')
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def compress(app, minSize=500, level=6, cacheSize=256):
+    """
+    compress starts compressing the responses of app.
+
+    args:
+    app - Flask application.
+    minSize - bodies smaller than this many bytes are sent uncompressed.
+    level - compression level from 1 (fast) to 9 (small).
+    cacheSize - number of compressed bodies kept.
+
+    returns:
+    FragmentCache of the compressed bodies.
+    """
+    cache = FragmentCache(size=cacheSize)
+
+    def compressStreamedResponse(response):
+        """Gzip compress a streamed response while it is sent."""
+        if request.accept_encodings.best_match(('gzip',)) is None:
+            return response
+        response.response = compressStream(response.response, level)
+        response.headers.pop('Content-Length', None)
+        response.headers['Content-Encoding'] = 'gzip'
+        etag, weak = response.get_etag()
+        if etag is not None:
+            response.set_etag('%s-gzip' % etag, weak)
+        return response
+
+    @app.after_request
+    def compressResponse(response):
+        if (response.mimetype not in COMPRESSIBLE_MIMETYPES or
+                response.direct_passthrough):
+            return response
+        response.vary.add('Accept-Encoding')
+        if (response.status_code != 200 or
+                'Content-Encoding' in response.headers):
+            return response
+        if response.is_streamed:
+            return compressStreamedResponse(response)
+        encoding = request.accept_encodings.best_match(ENCODINGS)
+        data = response.get_data()
+        if encoding is None or len(data) < minSize:
+            return response
+
+        etag, weak = response.get_etag()
+        key = (etag, encoding) if etag is not None else None
+        body = cache.get(key) if key is not None else None
+        if body is None:
+            body = compressBody(data, encoding, level)
+            if key is not None:
+                cache.set(key, body)
+        response.set_data(body)
+        response.headers['Content-Encoding'] = encoding
+        if etag is not None:
+            response.set_etag('%s-%s' % (etag, encoding), weak)
+        return response
+
+    return cache
@@ -5,14 +5,30 @@ This python scripts sets up database for Item Catalog Application.
 It creates database itemcatalog.db which has 3 tables - User, Category and
 Item. User table has id, name, email and picture as columns. Category table has
 id and name as columns. Item table has id, name, description, creation_date,
-category_id and user_id as columns.
+category_id and user_id as columns. The catalog_version table counts the
+writes to the whole catalog and to each category, and the item_fts full-text
+index (when SQLite has FTS5) serves the item search. Category also keeps its
+item count and last update time, and the latest_item table holds the newest
+items shown on the home page; both are maintained by the write routes.
+
+Running this script creates the database, or the database given by
+CATALOG_DATABASE_URL. On an existing itemcatalog.db it also creates any
+column and index that was added to the models after the database was
+created, so it is safe to run again after upgrading the application. Run it
+as `python database_setup.py rebuild-search` to rebuild the full-text index.
+Importing the module has no side effects.
 """
 
 import datetime
-from sqlalchemy import create_engine, Column, ForeignKey
+import os
+import sys
+from sqlalchemy import create_engine, event, inspect, Column, ForeignKey, Index
+from sqlalchemy import func, select
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.schema import CreateColumn
 from sqlalchemy import Integer, String, DateTime
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, sessionmaker
 
 
 Base = declarative_base()
@@ -25,7 +41,7 @@ class User(Base):
 
     id = Column(Integer, primary_key=True)
     name = Column(String(250), nullable=False)
-    email = Column(String(250), nullable=False)
+    email = Column(String(250), nullable=False, index=True)
     picture = Column(String(250))
 
     @property
@@ -46,6 +62,9 @@ class Category(Base):
 
     id = Column(Integer, primary_key=True)
     name = Column(String(80), nullable=False, unique=True)
+    item_count = Column(Integer, nullable=False, default=0,
+                        server_default='0')
+    last_updated = Column(DateTime)
 
     @property
     def serialize(self):
@@ -60,12 +79,20 @@ class Item(Base):
     """Item class has item info like id, name, desc, date, catId and user_id."""
 
     __tablename__ = 'item'
+    __table_args__ = (
+        # Serves the per-category ordering by creation date.
+        Index('ix_item_category_id_creation_date', 'category_id',
+              'creation_date'),
+    )
 
     id = Column(Integer, primary_key=True)
     name = Column(String(80), nullable=False, unique=True)
     description = Column(String(250))
-    creation_date = Column(DateTime, default=datetime.datetime.utcnow)
-    category_id = Column(Integer, ForeignKey('category.id'))
+    creation_date = Column(DateTime, default=datetime.datetime.utcnow,
+                           index=True)
+    # Indexed on its own too: the implicit rowid suffix of the index keeps the
+    # items of a category in id order for keyset pagination and export.
+    category_id = Column(Integer, ForeignKey('category.id'), index=True)
     user_id = Column(Integer, ForeignKey('user.id'))
     category = relationship(Category)
     user = relationship(User)
@@ -81,5 +108,416 @@ class Item(Base):
         }
 
 
-engine = create_engine('sqlite:///itemcatalog.db')
-Base.metadata.create_all(engine)
+class LatestItem(Base):
+    """LatestItem is a copy of one of the newest LATEST_ITEMS_SIZE items."""
+
+    __tablename__ = 'latest_item'
+
+    id = Column(Integer, ForeignKey('item.id'), primary_key=True,
+                autoincrement=False)
+    name = Column(String(80), nullable=False)
+    creation_date = Column(DateTime, index=True)
+    category_id = Column(Integer, ForeignKey('category.id'))
+    category = relationship(Category)
+
+
+LATEST_ITEMS_SIZE = 10
+
+
+class CatalogVersion(Base):
+    """CatalogVersion counts the writes to the catalog or to one category."""
+
+    __tablename__ = 'catalog_version'
+
+    # GLOBAL_VERSION is the version of the whole catalog and
+    # CATEGORY_LIST_VERSION the version of the list of category names, any
+    # other id is the id of the Category whose items changed.
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    version = Column(Integer, nullable=False, default=0)
+    updated = Column(DateTime)
+
+
+GLOBAL_VERSION = 0
+CATEGORY_LIST_VERSION = -1
+
+
+def bumpCatalogVersion(session, categoryIds=()):
+    """
+    bumpCatalogVersion increments the global and the given category versions.
+
+    It must be called in the same transaction as the write it records, so the
+    new versions become visible exactly when the write is committed.
+
+    args:
+    session - database session of the write.
+    categoryIds - ids of the categories whose items changed.
+    """
+    table = CatalogVersion.__table__
+    now = datetime.datetime.utcnow()
+    ids = set([GLOBAL_VERSION])
+    ids.update(id for id in categoryIds if id is not None)
+    for id in sorted(ids):
+        result = session.execute(
+            table.update().where(table.c.id == id).values(
+                version=table.c.version + 1, updated=now))
+        if not result.rowcount:
+            session.execute(table.insert().values(id=id, version=1,
+                                                  updated=now))
+
+
+def _trimLatestItems(session):
+    """Keep only the newest LATEST_ITEMS_SIZE rows of latest_item."""
+    table = LatestItem.__table__
+    newest = select([table.c.id]).order_by(
+        table.c.creation_date.desc()).limit(LATEST_ITEMS_SIZE)
+    session.execute(table.delete().where(~table.c.id.in_(newest)))
+
+
+def _countItem(session, categoryId, delta, now):
+    """Add delta to the item count of a category and mark it updated."""
+    if categoryId is None:
+        return
+    table = Category.__table__
+    session.execute(table.update().where(table.c.id == categoryId).values(
+        item_count=table.c.item_count + delta, last_updated=now))
+
+
+def recordItemAdded(session, item):
+    """
+    recordItemAdded updates the catalog stats for a newly added item.
+
+    It must be called after the item has been flushed, in the same
+    transaction.
+
+    args:
+    session - database session of the write.
+    item - the added Item.
+    """
+    _countItem(session, item.category_id, 1, datetime.datetime.utcnow())
+    session.execute(LatestItem.__table__.insert().values(
+        id=item.id, name=item.name, creation_date=item.creation_date,
+        category_id=item.category_id))
+    _trimLatestItems(session)
+
+
+def recordItemChanged(session, item, oldCategoryId):
+    """
+    recordItemChanged updates the catalog stats for an edited item.
+
+    args:
+    session - database session of the write.
+    item - the edited Item.
+    oldCategoryId - id of the category of the item before the edit.
+    """
+    now = datetime.datetime.utcnow()
+    if oldCategoryId != item.category_id:
+        _countItem(session, oldCategoryId, -1, now)
+        _countItem(session, item.category_id, 1, now)
+    else:
+        _countItem(session, item.category_id, 0, now)
+    table = LatestItem.__table__
+    session.execute(table.update().where(table.c.id == item.id).values(
+        name=item.name, category_id=item.category_id))
+
+
+def recordItemRemoved(session, item):
+    """
+    recordItemRemoved updates the catalog stats for a deleted item.
+
+    It must be called after the deletion has been flushed. If the item was
+    one of the latest items, the next newest item takes its place.
+
+    args:
+    session - database session of the write.
+    item - the deleted Item.
+    """
+    _countItem(session, item.category_id, -1, datetime.datetime.utcnow())
+    table = LatestItem.__table__
+    if not session.execute(table.delete().where(
+            table.c.id == item.id)).rowcount:
+        return
+    items = Item.__table__
+    replacement = session.execute(
+        select([items.c.id, items.c.name, items.c.creation_date,
+                items.c.category_id]).where(
+            ~items.c.id.in_(select([table.c.id]))).order_by(
+            items.c.creation_date.desc()).limit(1)).first()
+    if replacement is not None:
+        session.execute(table.insert().values(
+            id=replacement.id, name=replacement.name,
+            creation_date=replacement.creation_date,
+            category_id=replacement.category_id))
+
+
+def repairCatalogStats(session):
+    """
+    repairCatalogStats recomputes the item counts and the latest items.
+
+    Use it after writing items without going through the application, e.g.
+    after a bulk import, or to repair inconsistent stats. The last update
+    time of every category is reset to the creation date of its newest
+    item, as earlier edit times are not recorded anywhere else.
+
+    args:
+    session - database session. The caller commits.
+    """
+    categories = Category.__table__
+    items = Item.__table__
+    latest = LatestItem.__table__
+    session.execute(categories.update().values(
+        item_count=select([func.count(items.c.id)]).where(
+            items.c.category_id == categories.c.id).as_scalar(),
+        last_updated=select([func.max(items.c.creation_date)]).where(
+            items.c.category_id == categories.c.id).as_scalar()))
+    session.execute(latest.delete())
+    session.execute(latest.insert().from_select(
+        ['id', 'name', 'creation_date', 'category_id'],
+        select([items.c.id, items.c.name, items.c.creation_date,
+                items.c.category_id]).order_by(
+            items.c.creation_date.desc()).limit(LATEST_ITEMS_SIZE)))
+
+
+# PRAGMAs applied to every new SQLite connection. WAL lets readers carry on
+# while a writer commits. Each value can be overridden with an environment
+# variable CATALOG_SQLITE_<NAME>, e.g. CATALOG_SQLITE_MMAP_SIZE=0.
+SQLITE_PROFILE = [
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('mmap_size', '268435456'),
+    ('cache_size', '-65536'),
+    ('busy_timeout', '5000'),
+    ('temp_store', 'MEMORY'),
+]
+
+
+def sqliteProfile():
+    """
+    sqliteProfile returns the SQLite PRAGMAs with the environment overrides.
+
+    returns:
+    list of (pragma name, value) tuples.
+    """
+    return [(name, os.environ.get('CATALOG_SQLITE_%s' % name.upper(), value))
+            for name, value in SQLITE_PROFILE]
+
+
+def createEngine(url, readOnly=False, **kwargs):
+    """
+    createEngine creates an engine that applies the SQLite profile.
+
+    For SQLite databases every new connection is configured with the PRAGMAs
+    returned by sqliteProfile. A read-only engine additionally sets query_only
+    so that its connections refuse to write.
+
+    args:
+    url - database URL.
+    readOnly - True to create an engine that can only read.
+    kwargs - further arguments passed to create_engine.
+
+    returns:
+    SQLAlchemy engine.
+    """
+    engine = create_engine(url, **kwargs)
+    if engine.dialect.name != 'sqlite':
+        return engine
+    pragmas = sqliteProfile()
+    if readOnly:
+        pragmas.append(('query_only', 'ON'))
+
+    @event.listens_for(engine, 'connect')
+    def applySqliteProfile(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+        cursor.close()
+
+    return engine
+
+
+# External content FTS5 index over the item names and descriptions. The
+# triggers keep it in sync with every insert, update and delete on item, no
+# matter which code path writes the row.
+SEARCH_INDEX_TABLE = '''
+CREATE VIRTUAL TABLE item_fts USING fts5(
+    name, description, content='item', content_rowid='id', prefix='2 3')
+'''
+SEARCH_INDEX_TRIGGERS = [
+    '''
+    CREATE TRIGGER IF NOT EXISTS item_fts_insert AFTER INSERT ON item BEGIN
+        INSERT INTO item_fts(rowid, name, description)
+        VALUES (new.id, new.name, new.description);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS item_fts_delete AFTER DELETE ON item BEGIN
+        INSERT INTO item_fts(item_fts, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS item_fts_update
+    AFTER UPDATE OF name, description ON item BEGIN
+        INSERT INTO item_fts(item_fts, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+        INSERT INTO item_fts(rowid, name, description)
+        VALUES (new.id, new.name, new.description);
+    END
+    ''',
+]
+
+
+# Triggers that bump the category list and global versions whenever a
+# category is added, renamed or removed, so processes caching the category
+# list see writes of every other process, e.g. of importCatalog.py.
+CATEGORY_VERSION_TRIGGER = '''
+CREATE TRIGGER IF NOT EXISTS category_version_%(name)s
+AFTER %(event)s ON category BEGIN
+    INSERT OR IGNORE INTO catalog_version(id, version) VALUES (%(list)d, 0);
+    INSERT OR IGNORE INTO catalog_version(id, version) VALUES (%(global)d, 0);
+    UPDATE catalog_version SET version = version + 1,
+        updated = CURRENT_TIMESTAMP
+    WHERE id IN (%(list)d, %(global)d);
+END
+'''
+CATEGORY_VERSION_EVENTS = [('insert', 'INSERT'), ('delete', 'DELETE'),
+                           ('update', 'UPDATE OF name')]
+
+
+def createCategoryVersionTriggers(engine):
+    """
+    createCategoryVersionTriggers creates the category version triggers.
+
+    args:
+    engine - SQLAlchemy engine of the database.
+    """
+    if engine.dialect.name != 'sqlite':
+        return
+    with engine.begin() as connection:
+        for name, when in CATEGORY_VERSION_EVENTS:
+            connection.execute(CATEGORY_VERSION_TRIGGER % {
+                'name': name, 'event': when, 'list': CATEGORY_LIST_VERSION,
+                'global': GLOBAL_VERSION})
+
+
+def createSearchIndex(engine):
+    """
+    createSearchIndex creates and fills the item_fts index if it is missing.
+
+    Nothing is created when the SQLite library was built without FTS5; item
+    search is then unavailable but everything else keeps working.
+
+    args:
+    engine - SQLAlchemy engine of the database.
+
+    returns:
+    True if the index was created.
+    """
+    if engine.dialect.name != 'sqlite':
+        return False
+    if 'item_fts' in inspect(engine).get_table_names():
+        return False
+    with engine.begin() as connection:
+        try:
+            connection.execute(SEARCH_INDEX_TABLE)
+        except OperationalError:
+            return False
+        for trigger in SEARCH_INDEX_TRIGGERS:
+            connection.execute(trigger)
+        connection.execute("INSERT INTO item_fts(item_fts) VALUES('rebuild')")
+    return True
+
+
+def rebuildSearchIndex(engine):
+    """
+    rebuildSearchIndex rebuilds the item_fts index from the item table.
+
+    Databases created before item search get the index created and filled.
+
+    args:
+    engine - SQLAlchemy engine of the database.
+
+    returns:
+    False if the index cannot be created because FTS5 is unavailable.
+    """
+    if createSearchIndex(engine):
+        return True
+    if 'item_fts' not in inspect(engine).get_table_names():
+        return False
+    with engine.begin() as connection:
+        connection.execute("INSERT INTO item_fts(item_fts) VALUES('rebuild')")
+    return True
+
+
+def upgradeDatabase(engine):
+    """
+    upgradeDatabase adds model columns and indexes missing from a database.
+
+    create_all only creates missing tables, so columns and indexes added to
+    the models later are never created on an existing itemcatalog.db.
+    upgradeDatabase compares the columns and indexes of every table with the
+    ones in the database and creates the missing ones, then fills the catalog
+    stats if they were just added. Running it again is a no-op.
+
+    args:
+    engine - SQLAlchemy engine of the database to upgrade.
+
+    returns:
+    list of names of the created columns and indexes.
+    """
+    inspector = inspect(engine)
+    created = []
+    for table in Base.metadata.sorted_tables:
+        columns = set(column['name']
+                      for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in columns:
+                engine.execute('ALTER TABLE %s ADD COLUMN %s' % (
+                    table.name, CreateColumn(column).compile(
+                        dialect=engine.dialect)))
+                created.append('%s.%s' % (table.name, column.name))
+        existing = set(index['name']
+                       for index in inspector.get_indexes(table.name))
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            if index.name not in existing:
+                index.create(engine)
+                created.append(index.name)
+    if createSearchIndex(engine):
+        created.append('item_fts')
+    createCategoryVersionTriggers(engine)
+    if 'category.item_count' in created:
+        session = sessionmaker(bind=engine)()
+        repairCatalogStats(session)
+        session.commit()
+        session.close()
+    return created
+
+
+def createSchema(engine):
+    """
+    createSchema creates the tables of the models and upgrades old databases.
+
+    Importing this module does not touch any database; run
+    `python database_setup.py` or call createSchema before serving.
+
+    args:
+    engine - SQLAlchemy engine of the database.
+
+    returns:
+    list of names of the columns and indexes added to an existing database.
+    """
+    Base.metadata.create_all(engine)
+    return upgradeDatabase(engine)
+
+
+if __name__ == '__main__':
+    engine = createEngine(os.environ.get('CATALOG_DATABASE_URL',
+                                         'sqlite:///itemcatalog.db'))
+    if sys.argv[1:] == ['rebuild-search']:
+        if not rebuildSearchIndex(engine):
+            sys.exit('item search needs an SQLite library with FTS5')
+    elif sys.argv[1:] == ['repair-stats']:
+        session = sessionmaker(bind=engine)()
+        repairCatalogStats(session)
+        session.commit()
+    else:
+        createSchema(engine)
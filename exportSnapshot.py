@@ -0,0 +1,417 @@
+#!/usr/bin/env python
+"""
+This python script exports a static snapshot of Item Catalog Application.
+
+It renders every public page and JSON document as an anonymous visitor sees
+it, through the Flask test client with the application's own templates and
+serializers, into a folder that any static file server can serve:
+
+    /                                    index.html
+    /catalog/                            catalog/index.html
+    /catalog/category/1/items            catalog/category/1/items/index.html
+    /catalog/category/1/item/7           catalog/category/1/item/7/index.html
+    /catalog/categoryList                catalog/categoryList
+    /catalog/category/Soccer/itemsList   catalog/category/Soccer/itemsList
+    /catalog.json                        catalog.json
+    /static/styles.css                   static/styles.css
+
+HTML pages are written as index.html of their path and JSON documents at
+their exact path, so the server must send the files named categoryList and
+itemsList as application/json. The static folder, with the built assets of
+static/vendor, is copied along so the pages keep their styles and scripts.
+Logins, writes and search still need the application.
+
+    python exportSnapshot.py --database sqlite:///itemcatalog.db \
+        --output snapshot
+
+The snapshot folder keeps snapshot.json, a hash of every row the pages show.
+Running the script again only renders the pages whose rows changed since the
+last run, e.g. the item page, its category pages and the home page after an
+item is added, and deletes the pages of removed rows. Static files are
+copied again when their content changed and deleted when they are gone. A
+change of the templates or the built assets, or --full, renders and copies
+everything again. Pages are rendered by --processes worker processes.
+"""
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+try:
+    from urllib.parse import unquote
+except ImportError:
+    from urllib import unquote
+
+
+MANIFEST_NAME = 'snapshot.json'
+
+# Pages that only change with the templates.
+STATIC_URLS = ['/catalog/about']
+
+# Test client and output folder of a worker process.
+_worker = None
+
+
+def hashValues(values):
+    """Return a short hash of a row's values."""
+    return hashlib.sha1(repr(tuple(values)).encode('utf-8')).hexdigest()[:16]
+
+
+def templatesHash(app):
+    """
+    templatesHash returns a hash of everything every page depends on.
+
+    args:
+    app - Flask application.
+
+    returns:
+    hash of the templates and of the manifest of the built assets.
+    """
+    from assets import VENDOR_FOLDER, MANIFEST_NAME as ASSETS_MANIFEST
+    digest = hashlib.sha1()
+    for name in sorted(app.jinja_env.list_templates()):
+        source = app.jinja_loader.get_source(app.jinja_env, name)[0]
+        digest.update(('%s\n%s\n' % (name, source)).encode('utf-8'))
+    manifest = os.path.join(app.static_folder, VENDOR_FOLDER, ASSETS_MANIFEST)
+    if os.path.exists(manifest):
+        with open(manifest, 'rb') as source:
+            digest.update(source.read())
+    return digest.hexdigest()
+
+
+def staticHashes(app):
+    """
+    staticHashes hashes every file of the static folder.
+
+    args:
+    app - Flask application.
+
+    returns:
+    dict of the hash of every file by its path relative to the static
+    folder, with forward slashes.
+    """
+    hashes = {}
+    for folder, names, files in os.walk(app.static_folder):
+        names.sort()
+        for name in files:
+            path = os.path.join(folder, name)
+            with open(path, 'rb') as source:
+                digest = hashlib.sha1(source.read()).hexdigest()
+            relative = os.path.relpath(path, app.static_folder)
+            hashes[relative.replace(os.sep, '/')] = digest
+    return hashes
+
+
+def catalogState(session):
+    """
+    catalogState hashes every row the public pages show.
+
+    args:
+    session - database session.
+
+    returns:
+    dict with [name, hash] of every category under categories,
+    [category id, hash] of every item under items and a hash of the latest
+    items under latest. Ids are strings, as in the JSON manifest.
+    """
+    from application import EXPORT_BATCH_SIZE, ITEM_COLUMNS
+    from database_setup import Category, Item, LatestItem
+    categories = dict(
+        (str(row.id), [row.name, hashValues(row)])
+        for row in session.query(Category.id, Category.name,
+                                 Category.item_count))
+    items = dict(
+        (str(row.id), [row.category_id, hashValues(row)])
+        for row in session.query(*ITEM_COLUMNS).filter(
+            Item.category_id.isnot(None)).yield_per(EXPORT_BATCH_SIZE))
+    latest = hashValues(hashValues(row) for row in session.query(
+        LatestItem.id, LatestItem.name, LatestItem.category_id,
+        LatestItem.creation_date).order_by(LatestItem.id))
+    return {'categories': categories, 'items': items, 'latest': latest}
+
+
+def categoryURLs(categoryId, name):
+    """Return the URLs of the pages of a category."""
+    from flask import url_for
+    urls = [url_for('showItems', category_id=int(categoryId))]
+    # The URL of a name with a slash does not reach getItemsList, and a
+    # name of dots would escape the snapshot folder.
+    if '/' not in name and name.strip('.'):
+        urls.append(url_for('getItemsList', category_name=name))
+    return urls
+
+
+def itemURL(categoryId, itemId):
+    """Return the URL of the page of an item."""
+    from flask import url_for
+    return url_for('viewItem', category_id=categoryId, item_id=int(itemId))
+
+
+def stateURLs(state):
+    """Return the URL of every page of a catalog state."""
+    urls = set(['/', '/catalog/', '/catalog/categoryList', '/catalog.json'])
+    urls.update(STATIC_URLS)
+    for categoryId, (name, rowHash) in state['categories'].items():
+        urls.update(categoryURLs(categoryId, name))
+    for itemId, (categoryId, rowHash) in state['items'].items():
+        urls.add(itemURL(categoryId, itemId))
+    return urls
+
+
+def changedURLs(old, new):
+    """
+    changedURLs finds the pages whose rows changed between two states.
+
+    args:
+    old - catalog state of the last snapshot.
+    new - current catalog state.
+
+    returns:
+    set of the URLs to render again.
+    """
+    urls = set()
+    changedItems = [itemId for itemId in set(old['items']) | set(new['items'])
+                    if old['items'].get(itemId) != new['items'].get(itemId)]
+    # The pages of a category list its items and its item count.
+    categories = set(
+        categoryId for categoryId in set(old['categories']) |
+        set(new['categories'])
+        if old['categories'].get(categoryId) !=
+        new['categories'].get(categoryId))
+    for itemId in changedItems:
+        for state in (old, new):
+            if itemId in state['items']:
+                categories.add(str(state['items'][itemId][0]))
+        if itemId in new['items']:
+            urls.add(itemURL(new['items'][itemId][0], itemId))
+
+    # The category list, shown on the home page and the category pages.
+    names = dict((categoryId, name) for categoryId, (name, rowHash)
+                 in new['categories'].items())
+    sidebarChanged = names != dict(
+        (categoryId, name) for categoryId, (name, rowHash)
+        in old['categories'].items())
+    if sidebarChanged:
+        categories.update(new['categories'])
+        urls.add('/catalog/categoryList')
+    if sidebarChanged or old['latest'] != new['latest']:
+        urls.update(['/', '/catalog/'])
+    for categoryId in categories:
+        if categoryId in names:
+            urls.update(categoryURLs(categoryId, names[categoryId]))
+    if urls or changedItems:
+        urls.add('/catalog.json')
+    return urls
+
+
+def snapshotPath(url, mimetype):
+    """
+    snapshotPath returns the file a page is saved to.
+
+    args:
+    url - URL of the page.
+    mimetype - mimetype of the page.
+
+    returns:
+    path relative to the snapshot folder.
+    """
+    path = unquote(url).strip('/')
+    if mimetype != 'application/json':
+        path = os.path.join(path, 'index.html') if path else 'index.html'
+    return path
+
+
+def startWorker(database, output):
+    """Create the application of a worker process."""
+    global _worker
+    from application import create_app
+    app = create_app({'DATABASE_URL': database, 'METRICS': False,
+                      'COMPRESSION': False, 'ADMISSION': False})
+    _worker = (app.test_client(), output)
+
+
+def renderPage(url):
+    """
+    renderPage renders one page into the snapshot folder.
+
+    args:
+    url - URL of the page.
+
+    returns:
+    tuple of the URL, the HTTP status and the saved path or None.
+    """
+    client, output = _worker
+    response = client.get(url)
+    if response.status_code != 200:
+        return url, response.status_code, None
+    path = snapshotPath(url, response.mimetype)
+    target = os.path.join(output, path)
+    folder = os.path.dirname(target)
+    if not os.path.isdir(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:
+            # Another worker created it first.
+            if not os.path.isdir(folder):
+                raise
+    # Write to a temporary file first so the server never sends a partial
+    # page.
+    with open(target + '.tmp', 'wb') as page:
+        page.write(response.get_data())
+    os.rename(target + '.tmp', target)
+    return url, 200, path
+
+
+def removePage(output, path):
+    """Delete a file of the snapshot and the folders it leaves empty."""
+    target = os.path.join(output, path)
+    if os.path.exists(target):
+        os.remove(target)
+    folder = os.path.dirname(target)
+    while folder != output and os.path.isdir(folder) and \
+            not os.listdir(folder):
+        os.rmdir(folder)
+        folder = os.path.dirname(folder)
+
+
+def copyStaticFiles(app, output, old, new, full=False):
+    """
+    copyStaticFiles copies the static folder into the snapshot folder.
+
+    args:
+    app - Flask application.
+    output - snapshot folder.
+    old - hashes of the static files of the last snapshot.
+    new - current hashes of the static files, as returned by staticHashes.
+    full - copy every file, even when it did not change.
+
+    returns:
+    tuple of the number of files copied and removed.
+    """
+    prefix = app.static_url_path.strip('/')
+    copied = 0
+    for name, digest in sorted(new.items()):
+        path = os.path.join(prefix, *name.split('/'))
+        target = os.path.join(output, path)
+        if not full and old.get(name) == digest and os.path.exists(target):
+            continue
+        folder = os.path.dirname(target)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        shutil.copyfile(os.path.join(app.static_folder, *name.split('/')),
+                        target + '.tmp')
+        os.rename(target + '.tmp', target)
+        copied += 1
+    removed = set(old) - set(new)
+    for name in removed:
+        removePage(output, os.path.join(prefix, *name.split('/')))
+    return copied, len(removed)
+
+
+def renderPages(urls, database, output, processes):
+    """
+    renderPages renders pages with a pool of worker processes.
+
+    args:
+    urls - URLs of the pages.
+    database - database URL.
+    output - snapshot folder.
+    processes - number of worker processes, 1 to render in this process.
+
+    returns:
+    list of tuples (url, status, path) as returned by renderPage.
+    """
+    urls = sorted(urls)
+    if processes <= 1 or len(urls) < 2:
+        startWorker(database, output)
+        return [renderPage(url) for url in urls]
+    pool = multiprocessing.Pool(processes, initializer=startWorker,
+                                initargs=(database, output))
+    try:
+        chunk = max(1, min(100, len(urls) // (processes * 4)))
+        return list(pool.imap_unordered(renderPage, urls, chunk))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Export the public pages as a static snapshot.')
+    parser.add_argument('--database', default='sqlite:///itemcatalog.db',
+                        help='database URL (default: %(default)s)')
+    parser.add_argument('--output', default='snapshot',
+                        help='snapshot folder (default: %(default)s)')
+    parser.add_argument('--processes', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='worker processes (default: %(default)s)')
+    parser.add_argument('--full', action='store_true',
+                        help='render every page again')
+    args = parser.parse_args()
+
+    from application import create_app, DBSession
+    app = create_app({'DATABASE_URL': args.database})
+    output = os.path.abspath(args.output)
+    manifestPath = os.path.join(output, MANIFEST_NAME)
+    old = None
+    if os.path.exists(manifestPath):
+        with open(manifestPath) as source:
+            old = json.load(source)
+
+    start = time.time()
+    session = DBSession()
+    try:
+        state = catalogState(session)
+    finally:
+        session.close()
+    state['templates'] = templatesHash(app)
+    state['static'] = staticHashes(app)
+    full = args.full or old is None or old['templates'] != state['templates']
+    with app.test_request_context():
+        urls = stateURLs(state)
+        if full:
+            render = urls
+        else:
+            render = changedURLs(old, state)
+    files = dict(old['files']) if old is not None else {}
+
+    failed = 0
+    for url, status, path in renderPages(render, args.database, output,
+                                         args.processes):
+        if path is None:
+            print('%s returned %d' % (url, status))
+            failed += 1
+        else:
+            files[url] = path
+    if failed:
+        # Keep the last manifest so the next run renders these pages again.
+        print('%d pages failed, snapshot.json not updated' % failed)
+        return 1
+    # Snapshots written before static files were copied have no hashes.
+    copied, removed = copyStaticFiles(
+        app, output, old.get('static', {}) if old is not None else {},
+        state['static'], full)
+    stale = set(files) - urls
+    kept = set(path for url, path in files.items() if url in urls)
+    for url in stale:
+        if files[url] not in kept:
+            removePage(output, files[url])
+        del files[url]
+
+    state['files'] = files
+    with open(manifestPath + '.tmp', 'w') as target:
+        json.dump(state, target, sort_keys=True)
+    os.rename(manifestPath + '.tmp', manifestPath)
+    print('rendered %d pages, removed %d, %d unchanged, copied %d static '
+          'files, removed %d in %.1fs' % (
+              len(render), len(stale), len(urls) - len(render), copied,
+              removed, time.time() - start))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,12 +7,12 @@ and also items in some of the categories.
 """
 
 import sys
-from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
-from database_setup import Base, Category, Item, User
+from database_setup import Category, Item, User, createEngine, createSchema
+from database_setup import repairCatalogStats
 
-engine = create_engine('sqlite:///itemcatalog.db')
-Base.metadata.bind = engine
+engine = createEngine('sqlite:///itemcatalog.db')
+createSchema(engine)
 
 DBSession = sessionmaker(bind=engine)
 session = DBSession()
@@ -46,24 +46,31 @@ ItemsInEachCategory = {
                  diameter with a pronounced lip''']]
 }
 
+# Everything is added in a single transaction. For loading larger inventories
+# use importCatalog.py instead.
+
 # Add a dummy user to database
 user = User(id=1, name='Dummy',
             picture='https://img.icons8.com/windows/32/000000/contacts.png',
             email='dummy@gmail.com')
 session.add(user)
-session.commit()
 
 # Add category list to database
+categoriesByName = {}
 for category_name in categories:
     category = Category(name=category_name)
+    categoriesByName[category_name] = category
     session.add(category)
-    session.commit()
 
 # Add items for some of the categories
 for category in ItemsInEachCategory:
-    currentCategory = session.query(Category).filter_by(name=category).one()
+    currentCategory = categoriesByName[category]
     for item in ItemsInEachCategory[category]:
         newItem = Item(name=item[0], id=item[1], description=item[2],
                        category=currentCategory, user=user)
         session.add(newItem)
-        session.commit()
+
+# Fill the item counts and latest items from the rows added above
+session.flush()
+repairCatalogStats(session)
+session.commit()
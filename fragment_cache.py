@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""
+This module adds a fragment cache tag to the Jinja templates.
+
+The rendered HTML of a block between {% cache key, ... %} and {% endcache %}
+is stored under the given keys and reused by later renderings:
+
+    {% cache 'categoryList', categoryVersion %}
+      ...
+    {% endcache %}
+
+Keys must cover everything the block depends on, e.g. a catalog version, and
+blocks that depend on the login session must not be cached. The cache keeps
+at most a fixed number of fragments and evicts the least recently used one.
+"""
+
+import threading
+from collections import OrderedDict
+from jinja2 import nodes
+from jinja2.ext import Extension
+
+
+class FragmentCache(object):
+    """FragmentCache is a thread-safe LRU cache of rendered fragments."""
+
+    def __init__(self, size=256):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._fragments = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the fragment stored under key, or None."""
+        with self._lock:
+            fragment = self._fragments.pop(key, None)
+            if fragment is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._fragments[key] = fragment
+            return fragment
+
+    def set(self, key, fragment):
+        """Store fragment under key, evicting the least recently used one."""
+        with self._lock:
+            self._fragments.pop(key, None)
+            self._fragments[key] = fragment
+            while len(self._fragments) > self.size:
+                self._fragments.popitem(last=False)
+
+    def clear(self):
+        """Remove all fragments."""
+        with self._lock:
+            self._fragments.clear()
+
+    @property
+    def stats(self):
+        """Return the cache counters in easily serializeable format."""
+        return {
+            'size': len(self._fragments),
+            'maxSize': self.size,
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
+class FragmentCacheExtension(Extension):
+    """FragmentCacheExtension implements the {% cache %} template tag."""
+
+    tags = set(['cache'])
+
+    def __init__(self, environment):
+        super(FragmentCacheExtension, self).__init__(environment)
+        environment.extend(fragment_cache=FragmentCache())
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        keys = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            keys.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(
+            self.call_method('_renderCached', [nodes.List(keys)]),
+            [], [], body).set_lineno(lineno)
+
+    def _renderCached(self, keys, caller):
+        key = tuple(keys)
+        cache = self.environment.fragment_cache
+        fragment = cache.get(key)
+        if fragment is None:
+            fragment = caller()
+            cache.set(key, fragment)
+        return fragment
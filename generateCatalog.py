@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""
+This python script generates a synthetic itemcatalog.db for benchmarking.
+
+It fills a new database with the given number of users, categories and items
+using the models of database_setup.py. The same arguments and --seed always
+produce the same database, so benchmark runs against it can be compared.
+
+    python generateCatalog.py --database sqlite:///bench.db \
+        --categories 2000 --items 1000000
+"""
+
+import argparse
+import datetime
+import os
+import random
+import sys
+import time
+from sqlalchemy.orm import sessionmaker
+from database_setup import Category, Item, User, createEngine
+from database_setup import createSchema, repairCatalogStats
+
+
+WORDS = ('ball', 'bat', 'board', 'boot', 'cap', 'cleat', 'disc', 'glove',
+         'goal', 'helmet', 'jersey', 'mitt', 'net', 'pad', 'puck', 'racket',
+         'rope', 'shoe', 'skate', 'stick', 'wax', 'light', 'heavy', 'pro',
+         'junior', 'leather', 'carbon', 'wooden', 'classic', 'indoor')
+
+START_DATE = datetime.datetime(2019, 1, 1)
+
+
+def sentence(rng, words):
+    """Return a sentence of the given number of random words."""
+    return ' '.join(rng.choice(WORDS) for _ in range(words)).capitalize()
+
+
+def generate(engine, categories, items, users, seed, batchSize):
+    """
+    generate fills an empty database with synthetic rows.
+
+    args:
+    engine - SQLAlchemy engine of the database.
+    categories - number of categories.
+    items - number of items, spread randomly over the categories.
+    users - number of users owning the items.
+    seed - seed of the random number generator.
+    batchSize - number of rows inserted per executemany and commit.
+    """
+    rng = random.Random(seed)
+    with engine.begin() as connection:
+        connection.execute(User.__table__.insert(), [
+            {'id': u + 1, 'name': 'User %d' % (u + 1),
+             'email': 'user%d@example.com' % (u + 1), 'picture': None}
+            for u in range(users)])
+        connection.execute(Category.__table__.insert(), [
+            {'id': c + 1, 'name': 'Category %d' % (c + 1)}
+            for c in range(categories)])
+    for start in range(0, items, batchSize):
+        rows = []
+        for i in range(start, min(start + batchSize, items)):
+            rows.append({
+                'id': i + 1,
+                'name': '%s %d' % (sentence(rng, 2), i + 1),
+                'description': sentence(rng, rng.randint(5, 30)),
+                'creation_date': START_DATE + datetime.timedelta(seconds=i),
+                'category_id': rng.randint(1, categories),
+                'user_id': rng.randint(1, users),
+            })
+        with engine.begin() as connection:
+            connection.execute(Item.__table__.insert(), rows)
+    session = sessionmaker(bind=engine)()
+    repairCatalogStats(session)
+    session.commit()
+    session.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Generate a synthetic Item Catalog database.')
+    parser.add_argument('--database', default='sqlite:///bench.db',
+                        help='database URL (default: %(default)s)')
+    parser.add_argument('--categories', type=int, default=1000)
+    parser.add_argument('--items', type=int, default=100000)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--batch-size', type=int, default=10000)
+    parser.add_argument('--force', action='store_true',
+                        help='replace the database if it exists')
+    args = parser.parse_args()
+
+    path = args.database.split('sqlite:///', 1)[-1]
+    if args.database.startswith('sqlite:///') and os.path.exists(path):
+        if not args.force:
+            parser.error('%s exists, use --force to replace it' % path)
+        os.remove(path)
+    engine = createEngine(args.database)
+    createSchema(engine)
+    start = time.time()
+    generate(engine, args.categories, args.items, args.users, args.seed,
+             args.batch_size)
+    print('generated %d categories and %d items in %.1fs' % (
+        args.categories, args.items, time.time() - start))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+"""
+This module talks to the Google OAuth endpoints used by the login.
+
+GoogleClient keeps one pooled keep-alive HTTP session for all requests, so
+logins and logouts reuse open connections instead of paying TCP and TLS setup
+every time. The session is shared by all users, so it neither stores nor
+sends cookies. Validated tokeninfo results are cached until the token
+expires.
+
+The endpoint URLs and timeouts are read from the environment, so the client
+can be pointed at a local stub server:
+
+    CATALOG_GOOGLE_TOKENINFO_URL, CATALOG_GOOGLE_USERINFO_URL,
+    CATALOG_GOOGLE_REVOKE_URL - endpoint URLs.
+    CATALOG_GOOGLE_CONNECT_TIMEOUT, CATALOG_GOOGLE_READ_TIMEOUT - seconds.
+    CATALOG_GOOGLE_POOL_SIZE - connections kept open per host.
+"""
+
+import os
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+try:
+    from http.cookiejar import DefaultCookiePolicy
+except ImportError:
+    from cookielib import DefaultCookiePolicy
+
+
+TOKENINFO_URL = 'https://www.googleapis.com/oauth2/v1/tokeninfo'
+USERINFO_URL = 'https://www.googleapis.com/oauth2/v1/userinfo'
+REVOKE_URL = 'https://accounts.google.com/o/oauth2/revoke'
+
+# Upper bound on cached tokeninfo results; expired ones are dropped first.
+TOKEN_CACHE_SIZE = 10000
+
+
+class NoCookies(DefaultCookiePolicy):
+    """NoCookies refuses to store or send any cookie."""
+
+    def set_ok(self, cookie, request):
+        return False
+
+    def return_ok(self, cookie, request):
+        return False
+
+    def domain_return_ok(self, domain, request):
+        return False
+
+
+class GoogleClient(object):
+    """GoogleClient calls the tokeninfo, userinfo and revoke endpoints."""
+
+    def __init__(self, tokeninfoURL=TOKENINFO_URL, userinfoURL=USERINFO_URL,
+                 revokeURL=REVOKE_URL, timeout=(3.05, 10), poolSize=10):
+        self.tokeninfoURL = tokeninfoURL
+        self.userinfoURL = userinfoURL
+        self.revokeURL = revokeURL
+        self.timeout = timeout
+        self.http = requests.Session()
+        # Cookies set for one user must not be sent with another's tokens.
+        self.http.cookies.set_policy(NoCookies())
+        adapter = HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize)
+        self.http.mount('https://', adapter)
+        self.http.mount('http://', adapter)
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def tokenInfo(self, accessToken):
+        """
+        tokenInfo returns the tokeninfo of an access token.
+
+        Results without an error are cached for the remaining lifetime of the
+        token (expires_in), so validating the same token again is free.
+
+        args:
+        accessToken - OAuth access token.
+
+        returns:
+        tokeninfo dict.
+        """
+        now = time.time()
+        with self._lock:
+            cached = self._tokens.get(accessToken)
+            if cached is not None and cached[0] > now:
+                return cached[1]
+        result = self.http.get(self.tokeninfoURL,
+                               params={'access_token': accessToken},
+                               timeout=self.timeout).json()
+        expiresIn = result.get('expires_in')
+        if result.get('error') is None and expiresIn:
+            with self._lock:
+                if len(self._tokens) >= TOKEN_CACHE_SIZE:
+                    self._dropExpired(now)
+                if len(self._tokens) < TOKEN_CACHE_SIZE:
+                    self._tokens[accessToken] = (now + int(expiresIn),
+                                                 result)
+        return result
+
+    def _dropExpired(self, now):
+        """Remove expired tokeninfo results. The lock must be held."""
+        for token, (expires, _) in list(self._tokens.items()):
+            if expires <= now:
+                del self._tokens[token]
+
+    def userInfo(self, accessToken):
+        """
+        userInfo returns the profile of the user of an access token.
+
+        args:
+        accessToken - OAuth access token.
+
+        returns:
+        userinfo dict with name, email and picture.
+        """
+        return self.http.get(self.userinfoURL,
+                             params={'access_token': accessToken,
+                                     'alt': 'json'},
+                             timeout=self.timeout).json()
+
+    def tokenAndUserInfo(self, accessToken):
+        """
+        tokenAndUserInfo fetches tokeninfo and userinfo concurrently.
+
+        args:
+        accessToken - OAuth access token.
+
+        returns:
+        tuple of the tokeninfo and userinfo dicts. Errors of either request
+        are raised.
+        """
+        results = {}
+
+        def fetchUserInfo():
+            try:
+                results['userinfo'] = self.userInfo(accessToken)
+            except Exception as error:
+                results['error'] = error
+
+        thread = threading.Thread(target=fetchUserInfo)
+        thread.daemon = True
+        thread.start()
+        try:
+            tokenInfo = self.tokenInfo(accessToken)
+        finally:
+            thread.join()
+        if 'error' in results:
+            raise results['error']
+        return tokenInfo, results['userinfo']
+
+    def revoke(self, accessToken):
+        """
+        revoke revokes an access token and forgets its cached tokeninfo.
+
+        args:
+        accessToken - OAuth access token.
+
+        returns:
+        HTTP status code of the revoke request.
+        """
+        with self._lock:
+            self._tokens.pop(accessToken, None)
+        response = self.http.get(self.revokeURL,
+                                 params={'token': accessToken},
+                                 timeout=self.timeout)
+        return response.status_code
+
+
+def clientFromEnvironment():
+    """
+    clientFromEnvironment creates a GoogleClient configured by environment.
+
+    returns:
+    GoogleClient.
+    """
+    return GoogleClient(
+        tokeninfoURL=os.environ.get('CATALOG_GOOGLE_TOKENINFO_URL',
+                                    TOKENINFO_URL),
+        userinfoURL=os.environ.get('CATALOG_GOOGLE_USERINFO_URL',
+                                   USERINFO_URL),
+        revokeURL=os.environ.get('CATALOG_GOOGLE_REVOKE_URL', REVOKE_URL),
+        timeout=(float(os.environ.get('CATALOG_GOOGLE_CONNECT_TIMEOUT', 3.05)),
+                 float(os.environ.get('CATALOG_GOOGLE_READ_TIMEOUT', 10))),
+        poolSize=int(os.environ.get('CATALOG_GOOGLE_POOL_SIZE', 10)))
@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+"""
+This python script imports items into the itemcatalog.db database.
+
+It reads items from CSV, JSON or NDJSON files. Every item has a name and
+optionally a description, a category, a creation_date and the email, name and
+picture of the user who owns it. JSON files hold either a list of items or the
+document served by /catalog.json. Categories and users are created when they
+do not exist yet. New items without a category are skipped. Items that
+already exist are skipped, or updated with --upsert; an update only changes
+the description, category and owner a record provides and keeps the stored
+values of the fields it leaves out.
+
+Rows are inserted with executemany in batches of --batch-size rows and
+committed every --transaction-size rows.
+
+    python importCatalog.py items.csv more-items.ndjson --upsert
+"""
+
+import argparse
+import csv
+import datetime
+import io
+import json
+import os
+import sys
+import time
+from sqlalchemy import bindparam
+from sqlalchemy.orm import sessionmaker
+from database_setup import Category, Item, User, createEngine
+from database_setup import bumpCatalogVersion, repairCatalogStats
+from database_setup import createSchema
+
+
+# Largest number of values bound in one IN clause; older SQLite builds allow
+# at most 999 variables per statement.
+IN_CLAUSE_SIZE = 500
+
+# Item columns an upsert changes when a record provides them.
+UPDATE_COLUMNS = ('description', 'category_id', 'user_id')
+
+DATE_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S',
+                '%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d')
+
+
+def readCSV(path):
+    """Yield the rows of a CSV file with a header line as dicts."""
+    with open(path, 'rb') as csvFile:
+        for row in csv.DictReader(csvFile):
+            yield dict((key, value.decode('utf-8') if value else None)
+                       for key, value in row.items())
+
+
+def readNDJSON(path):
+    """Yield the objects of a file with one JSON object per line."""
+    with io.open(path, encoding='utf-8') as jsonFile:
+        for line in jsonFile:
+            if line.strip():
+                yield json.loads(line)
+
+
+def readJSON(path):
+    """Yield the items of a JSON list or of a /catalog.json document."""
+    with io.open(path, encoding='utf-8') as jsonFile:
+        data = json.load(jsonFile)
+    if isinstance(data, list):
+        for record in data:
+            yield record
+        return
+    for category in data.get('Category', []):
+        for record in category.get('item', []):
+            record = dict(record)
+            record['category'] = category['name']
+            yield record
+
+
+READERS = {
+    '.csv': readCSV,
+    '.json': readJSON,
+    '.ndjson': readNDJSON,
+    '.jsonl': readNDJSON,
+}
+
+
+def readRecords(paths):
+    """
+    readRecords yields the item records of all given files.
+
+    args:
+    paths - list of file paths. The format is chosen by the file extension.
+    """
+    for path in paths:
+        extension = os.path.splitext(path)[1].lower()
+        if extension not in READERS:
+            raise ValueError('Unsupported file format: %s' % path)
+        for record in READERS[extension](path):
+            yield record
+
+
+def parseDate(value):
+    """Return value as a datetime, or the current time if it is empty."""
+    if not value:
+        return datetime.datetime.utcnow()
+    for dateFormat in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, dateFormat)
+        except ValueError:
+            pass
+    raise ValueError('Unsupported creation_date: %s' % value)
+
+
+def chunks(values, size):
+    """Yield successive lists of at most size values."""
+    chunk = []
+    for value in values:
+        chunk.append(value)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def selectIds(session, column, idColumn, values):
+    """
+    selectIds looks up the ids of the rows whose column is one of values.
+
+    returns:
+    dict mapping column value to id.
+    """
+    ids = {}
+    for chunk in chunks(sorted(values), IN_CLAUSE_SIZE):
+        for value, id in session.query(column, idColumn).filter(
+                column.in_(chunk)):
+            ids[value] = id
+    return ids
+
+
+class CatalogImporter(object):
+    """
+    CatalogImporter writes batches of item records into the database.
+
+    Category and user ids are resolved once per batch with a single query for
+    all names and emails of the batch that are not known yet, and remembered
+    for the following batches.
+    """
+
+    def __init__(self, session, upsert=False, defaultEmail=None):
+        self.session = session
+        self.upsert = upsert
+        self.defaultEmail = defaultEmail
+        self.categoryIds = {}
+        self.userIds = {}
+        self.inserted = 0
+        self.updated = 0
+        self.skipped = 0
+
+    def resolveCategories(self, records):
+        """Create the missing categories of records and learn their ids."""
+        names = set(record['category'] for record in records
+                    if record['category'] and
+                    record['category'] not in self.categoryIds)
+        if not names:
+            return
+        self.categoryIds.update(selectIds(self.session, Category.name,
+                                          Category.id, names))
+        missing = names.difference(self.categoryIds)
+        if missing:
+            self.session.execute(Category.__table__.insert(),
+                                 [{'name': name} for name in missing])
+            self.categoryIds.update(selectIds(self.session, Category.name,
+                                              Category.id, missing))
+
+    def resolveUsers(self, records):
+        """Create the missing users of records and learn their ids."""
+        users = {}
+        for record in records:
+            email = record['email']
+            if email and email not in self.userIds:
+                users[email] = record
+        if not users:
+            return
+        self.userIds.update(selectIds(self.session, User.email, User.id,
+                                      users))
+        missing = [address for address in users
+                   if address not in self.userIds]
+        if missing:
+            self.session.execute(User.__table__.insert(), [
+                {'email': address,
+                 'name': (users[address].get('user_name') or
+                          address.split('@')[0]),
+                 'picture': users[address].get('user_picture')}
+                for address in missing])
+            self.userIds.update(selectIds(self.session, User.email, User.id,
+                                          missing))
+
+    def importBatch(self, batch):
+        """
+        importBatch inserts or updates one batch of item records.
+
+        args:
+        batch - list of item record dicts.
+        """
+        records = {}
+        for record in batch:
+            if not record.get('name'):
+                continue
+            item = {
+                'name': record['name'],
+                'category': record.get('category'),
+                'email': record.get('user_email') or self.defaultEmail,
+                'user_name': record.get('user_name'),
+                'user_picture': record.get('user_picture'),
+                'creation_date': parseDate(record.get('creation_date')),
+            }
+            if 'description' in record:
+                item['description'] = record['description']
+            records[record['name']] = item
+        # Nameless records are skipped, later records of the same name
+        # replace earlier ones.
+        self.skipped += len(batch) - len(records)
+        records = list(records.values())
+        self.resolveCategories(records)
+        self.resolveUsers(records)
+        existing = selectIds(self.session, Item.name, Item.id,
+                             [record['name'] for record in records])
+        # Rows only hold the columns their record provides, so an update
+        # keeps the stored values of the others.
+        rows = []
+        for record in records:
+            row = {'name': record['name'],
+                   'creation_date': record['creation_date']}
+            if 'description' in record:
+                row['description'] = record['description']
+            if record['category'] in self.categoryIds:
+                row['category_id'] = self.categoryIds[record['category']]
+            if record['email'] in self.userIds:
+                row['user_id'] = self.userIds[record['email']]
+            rows.append(row)
+        inserts = []
+        for row in rows:
+            if row['name'] in existing:
+                continue
+            # No page shows an item without a category.
+            if 'category_id' not in row:
+                self.skipped += 1
+                continue
+            row.setdefault('description', None)
+            row.setdefault('user_id', None)
+            inserts.append(row)
+        updates = [row for row in rows if row['name'] in existing]
+        if not self.upsert:
+            self.skipped += len(updates)
+            updates = []
+        if not inserts and not updates:
+            return
+        # Updated items may move, so their old categories change as well.
+        changed = set(row['category_id'] for row in inserts + updates
+                      if 'category_id' in row)
+        for chunk in chunks([existing[row['name']] for row in updates],
+                            IN_CLAUSE_SIZE):
+            changed.update(categoryId for categoryId, in self.session.query(
+                Item.category_id).filter(Item.id.in_(chunk)))
+        if inserts:
+            self.session.execute(Item.__table__.insert(), inserts)
+            self.inserted += len(inserts)
+        # One executemany per set of provided columns.
+        groups = {}
+        for row in updates:
+            row['_id'] = existing[row['name']]
+            del row['creation_date']
+            columns = tuple(column for column in UPDATE_COLUMNS
+                            if column in row)
+            groups.setdefault(columns, []).append(row)
+        for columns, group in groups.items():
+            if not columns:
+                self.skipped += len(group)
+                continue
+            self.session.execute(
+                Item.__table__.update().where(
+                    Item.id == bindparam('_id')).values(
+                    **dict((column, bindparam(column))
+                           for column in columns)),
+                group)
+            self.updated += len(group)
+        bumpCatalogVersion(self.session, changed)
+
+
+def importRecords(session, records, batchSize=500, transactionSize=10000,
+                  upsert=False, defaultEmail=None):
+    """
+    importRecords imports item records in batched transactions.
+
+    args:
+    session - database session.
+    records - iterable of item record dicts.
+    batchSize - number of rows written per executemany.
+    transactionSize - number of rows written per commit.
+    upsert - True to update items that already exist.
+    defaultEmail - email of the owner of records without user_email.
+
+    returns:
+    CatalogImporter with the inserted, updated and skipped counts.
+    """
+    importer = CatalogImporter(session, upsert=upsert,
+                               defaultEmail=defaultEmail)
+    pending = 0
+    for batch in chunks(records, batchSize):
+        importer.importBatch(batch)
+        pending += len(batch)
+        if pending >= transactionSize:
+            session.commit()
+            pending = 0
+    # Item counts and latest items are recomputed once for the whole import.
+    repairCatalogStats(session)
+    session.commit()
+    return importer
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Import items into the Item Catalog database.')
+    parser.add_argument('files', nargs='+',
+                        help='CSV, JSON or NDJSON files to import')
+    parser.add_argument('--database', default='sqlite:///itemcatalog.db',
+                        help='database URL (default: %(default)s)')
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help='rows per executemany (default: %(default)s)')
+    parser.add_argument('--transaction-size', type=int, default=10000,
+                        help='rows per commit (default: %(default)s)')
+    parser.add_argument('--upsert', action='store_true',
+                        help='update items that already exist')
+    parser.add_argument('--user-email',
+                        help='owner of items that have no user_email')
+    args = parser.parse_args()
+
+    engine = createEngine(args.database)
+    createSchema(engine)
+    session = sessionmaker(bind=engine)()
+    start = time.time()
+    importer = importRecords(session, readRecords(args.files),
+                             batchSize=args.batch_size,
+                             transactionSize=args.transaction_size,
+                             upsert=args.upsert,
+                             defaultEmail=args.user_email)
+    elapsed = max(time.time() - start, 1e-6)
+    total = importer.inserted + importer.updated
+    print('inserted %d, updated %d, skipped %d items in %.2fs (%d rows/sec)'
+          % (importer.inserted, importer.updated, importer.skipped, elapsed,
+             total / elapsed))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+"""
+This module instruments Item Catalog Application for monitoring.
+
+instrument hooks into a Flask app and its SQLAlchemy engines and records, per
+endpoint, the request count and latency, the SQL statement count and time,
+and per template the render time. Statements slower than a threshold are
+logged. Everything is exposed in Prometheus text format at /metrics.
+
+Template render times come from Flask's template signals, which need the
+optional blinker package (pip install blinker); without it they are not
+recorded and everything else still is.
+
+Nothing is hooked in unless instrument is called, so an app running without
+instrumentation pays nothing for it.
+"""
+
+import bisect
+import logging
+import threading
+import time
+from flask import g, has_request_context, request
+from flask import before_render_template, template_rendered
+from flask.signals import signals_available
+from sqlalchemy import event
+
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds of the latency histogram buckets.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    """Histogram counts observations in cumulative latency buckets."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """Add one observation."""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels):
+        """Return the Prometheus sample lines of the histogram."""
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            lines.append('%s_bucket{%sle="%s"} %d' % (name, labels, bound,
+                                                      cumulative))
+        lines.append('%s_sum{%s} %f' % (name, labels.rstrip(','), self.sum))
+        lines.append('%s_count{%s} %d' % (name, labels.rstrip(','),
+                                          self.count))
+        return lines
+
+
+def formatLabels(names, values):
+    """Return Prometheus labels, each followed by a comma."""
+    return ''.join('%s="%s",' % (name, str(value).replace('\\', '\\\\')
+                                 .replace('"', '\\"'))
+                   for name, value in zip(names, values))
+
+
+class Metrics(object):
+    """Metrics holds the counters and histograms of the instrumented app."""
+
+    def __init__(self, slowQuerySeconds=0.1):
+        self.slowQuerySeconds = slowQuerySeconds
+        self.requests = {}
+        self.requestLatency = {}
+        self.sqlStatements = {}
+        self.sqlSeconds = {}
+        self.templateLatency = {}
+        self.slowQueries = 0
+        self.gauges = []
+        self._lock = threading.Lock()
+
+    def recordRequest(self, endpoint, method, status, seconds, statements,
+                      sqlSeconds):
+        """Record one handled request."""
+        with self._lock:
+            key = (endpoint, method, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            if endpoint not in self.requestLatency:
+                self.requestLatency[endpoint] = Histogram()
+                self.sqlStatements[endpoint] = 0
+                self.sqlSeconds[endpoint] = 0.0
+            self.requestLatency[endpoint].observe(seconds)
+            self.sqlStatements[endpoint] += statements
+            self.sqlSeconds[endpoint] += sqlSeconds
+
+    def recordTemplate(self, template, seconds):
+        """Record one template rendering."""
+        with self._lock:
+            if template not in self.templateLatency:
+                self.templateLatency[template] = Histogram()
+            self.templateLatency[template].observe(seconds)
+
+    def recordSlowQuery(self):
+        """Count one statement slower than the slow query threshold."""
+        with self._lock:
+            self.slowQueries += 1
+
+    def watchEngine(self, engine):
+        """
+        watchEngine records the statements executed by a SQLAlchemy engine.
+
+        args:
+        engine - SQLAlchemy engine.
+        """
+        event.listen(engine, 'before_cursor_execute',
+                     self._startStatementTimer)
+        event.listen(engine, 'after_cursor_execute', self._recordStatement)
+
+    def _startStatementTimer(self, conn, cursor, statement, parameters,
+                             context, executemany):
+        conn.info.setdefault('metrics_start', []).append(time.time())
+
+    def _recordStatement(self, conn, cursor, statement, parameters, context,
+                         executemany):
+        seconds = time.time() - conn.info['metrics_start'].pop()
+        if has_request_context() and 'metricsStatements' in g:
+            g.metricsStatements += 1
+            g.metricsSQLSeconds += seconds
+        if seconds >= self.slowQuerySeconds:
+            self.recordSlowQuery()
+            logger.warning('Slow query (%.3fs): %s', seconds,
+                           ' '.join(statement.split()))
+
+    def addGauge(self, name, help, read):
+        """
+        addGauge exposes a value read at scrape time.
+
+        args:
+        name - metric name.
+        help - metric description.
+        read - function returning the current value.
+        """
+        self.gauges.append((name, help, read))
+
+    def render(self):
+        """Return all metrics in Prometheus text format."""
+        lines = []
+
+        def header(name, help, kind):
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+
+        with self._lock:
+            header('catalog_requests_total', 'Handled requests.', 'counter')
+            for key, count in sorted(self.requests.items()):
+                lines.append('catalog_requests_total{%s} %d' % (formatLabels(
+                    ('endpoint', 'method', 'status'), key).rstrip(','),
+                    count))
+            header('catalog_request_duration_seconds',
+                   'Request latency by endpoint.', 'histogram')
+            for endpoint, histogram in sorted(self.requestLatency.items()):
+                lines.extend(histogram.lines(
+                    'catalog_request_duration_seconds',
+                    formatLabels(('endpoint',), (endpoint,))))
+            header('catalog_sql_statements_total',
+                   'SQL statements executed by endpoint.', 'counter')
+            for endpoint, count in sorted(self.sqlStatements.items()):
+                lines.append('catalog_sql_statements_total{%s} %d' % (
+                    formatLabels(('endpoint',), (endpoint,)).rstrip(','),
+                    count))
+            header('catalog_sql_seconds_total',
+                   'Time spent executing SQL by endpoint.', 'counter')
+            for endpoint, seconds in sorted(self.sqlSeconds.items()):
+                lines.append('catalog_sql_seconds_total{%s} %f' % (
+                    formatLabels(('endpoint',), (endpoint,)).rstrip(','),
+                    seconds))
+            header('catalog_template_render_seconds',
+                   'Template render time.', 'histogram')
+            for template, histogram in sorted(self.templateLatency.items()):
+                lines.extend(histogram.lines(
+                    'catalog_template_render_seconds',
+                    formatLabels(('template',), (template,))))
+            header('catalog_slow_queries_total',
+                   'SQL statements slower than the threshold.', 'counter')
+            lines.append('catalog_slow_queries_total %d' % self.slowQueries)
+        for name, help, read in self.gauges:
+            header(name, help, 'gauge')
+            lines.append('%s %s' % (name, read()))
+        return '\n'.join(lines) + '\n'
+
+
+def instrument(app, engines=(), slowQuerySeconds=0.1):
+    """
+    instrument starts recording metrics for app and serves them at /metrics.
+
+    args:
+    app - Flask application.
+    engines - SQLAlchemy engines used by the application. Engines created
+              later are added with Metrics.watchEngine.
+    slowQuerySeconds - statements slower than this are logged.
+
+    returns:
+    Metrics of the app.
+    """
+    metrics = Metrics(slowQuerySeconds)
+
+    @app.before_request
+    def startRequestTimer():
+        g.metricsStart = time.time()
+        g.metricsStatements = 0
+        g.metricsSQLSeconds = 0.0
+
+    @app.after_request
+    def recordRequest(response):
+        start = g.get('metricsStart')
+        if start is not None:
+            endpoint = request.endpoint or 'unmatched'
+            metrics.recordRequest(endpoint, request.method,
+                                  response.status_code, time.time() - start,
+                                  g.metricsStatements, g.metricsSQLSeconds)
+        return response
+
+    for engine in set(engines):
+        metrics.watchEngine(engine)
+
+    def startTemplateTimer(sender, template, context, **extra):
+        g.setdefault('metricsTemplates', []).append(time.time())
+
+    def recordTemplate(sender, template, context, **extra):
+        starts = g.get('metricsTemplates')
+        if starts:
+            metrics.recordTemplate(template.name or 'string',
+                                   time.time() - starts.pop())
+
+    if signals_available:
+        before_render_template.connect(startTemplateTimer, app, weak=False)
+        template_rendered.connect(recordTemplate, app, weak=False)
+    else:
+        logger.info('blinker is not installed, template render times are '
+                    'not recorded')
+
+    @app.route('/metrics')
+    def getMetrics():
+        """
+        getMetrics returns the application metrics in Prometheus format.
+
+        return:
+        metrics in Prometheus text exposition format.
+        """
+        return app.response_class(metrics.render(),
+                                  mimetype='text/plain; version=0.0.4')
+
+    return metrics
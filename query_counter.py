@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""
+This module counts the SQL statements executed by Item Catalog Application.
+
+A QueryCounter records every statement sent to the database by the current
+thread while it is active. The application opens one counter per request, and
+tests or checks can open their own around any block of code:
+
+    with QueryCounter() as counter:
+        client.get('/catalog/')
+    print(counter.count)
+"""
+
+import threading
+from sqlalchemy import event
+
+
+_local = threading.local()
+
+
+def _recordStatement(conn, cursor, statement, parameters, context,
+                     executemany):
+    """Pass an executed statement to every active counter of this thread."""
+    for counter in getattr(_local, 'counters', ()):
+        counter.statements.append((statement, parameters))
+
+
+def installQueryCounter(engine):
+    """
+    installQueryCounter starts counting the statements executed by engine.
+
+    args:
+    engine - SQLAlchemy engine to listen on.
+    """
+    if not event.contains(engine, 'before_cursor_execute', _recordStatement):
+        event.listen(engine, 'before_cursor_execute', _recordStatement)
+
+
+class QueryCounter(object):
+    """QueryCounter records statements executed by the current thread."""
+
+    def __init__(self):
+        self.statements = []
+
+    @property
+    def count(self):
+        """Return the number of statements recorded so far."""
+        return len(self.statements)
+
+    def __enter__(self):
+        if not hasattr(_local, 'counters'):
+            _local.counters = []
+        _local.counters.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _local.counters.remove(self)
+        return False
+
+
+def assertQueryCount(expected, counter):
+    """
+    assertQueryCount raises AssertionError if counter saw a different count.
+
+    args:
+    expected - expected number of statements.
+    counter - QueryCounter to check.
+    """
+    if counter.count != expected:
+        raise AssertionError(
+            'Expected %d SQL statements, got %d:\n%s' % (
+                expected, counter.count,
+                '\n'.join(statement for statement, _ in counter.statements)))
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""
+This python script serves Item Catalog Application in production.
+
+It runs the application under gunicorn with several worker processes, each
+with a pool of threads, so requests are spread over all CPU cores instead of
+the single process of `python application.py`. The debugger and reloader are
+off. gunicorn is only needed for this script: pip install gunicorn (and
+futures on Python 2 for the threaded workers).
+
+    CATALOG_SECRET_KEY=... python serve.py --workers 4 --threads 8
+
+Every worker creates the application itself after the fork (no preload), so
+it opens its own database engine. Before it accepts requests it opens the
+connection pool, loads the category cache and compiles the templates.
+
+Send SIGHUP to the master process to restart the workers gracefully, e.g.
+after a deploy: new workers are started and the old ones finish their
+requests first. SIGTERM stops the server gracefully.
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:
+    BaseApplication = object
+
+
+def warmUp(app):
+    """
+    warmUp prepares a worker's application before it accepts requests.
+
+    It opens the database engine, loads the category list into the
+    category cache and compiles every template.
+
+    args:
+    app - Flask application.
+    """
+    from application import database, getCategories, readSession
+    database.engines()
+    with app.app_context():
+        getCategories()
+        readSession.remove()
+    for name in app.jinja_env.list_templates(extensions=['html']):
+        app.jinja_env.get_template(name)
+
+
+def postWorkerInit(worker):
+    """Warm the application of a new worker before it serves requests."""
+    warmUp(worker.wsgi)
+    worker.log.info('Worker %s warmed up', worker.pid)
+
+
+def workerExit(server, worker):
+    """Commit the writes still queued in a worker that is shutting down."""
+    app = getattr(worker, 'wsgi', None)
+    writeQueue = app.extensions.get('writeQueue') if app else None
+    if writeQueue is not None:
+        writeQueue.stop()
+
+
+class CatalogServer(BaseApplication):
+    """CatalogServer runs the application with gunicorn."""
+
+    def __init__(self, options, config):
+        """
+        args:
+        options - gunicorn settings.
+        config - config values passed to create_app.
+        """
+        self.options = options
+        self.config = config
+        super(CatalogServer, self).__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+        self.cfg.set('post_worker_init', postWorkerInit)
+        self.cfg.set('worker_exit', workerExit)
+
+    def load(self):
+        from application import create_app
+        return create_app(self.config)
+
+
+def main():
+    env = os.environ.get
+    parser = argparse.ArgumentParser(
+        description='Serve Item Catalog Application with gunicorn.')
+    parser.add_argument('--bind', default=env('CATALOG_BIND', '0.0.0.0:8000'),
+                        help='address to listen on (default: %(default)s)')
+    parser.add_argument('--workers', type=int,
+                        default=int(env('CATALOG_WORKERS',
+                                        multiprocessing.cpu_count())),
+                        help='worker processes (default: %(default)s)')
+    parser.add_argument('--threads', type=int,
+                        default=int(env('CATALOG_THREADS', 4)),
+                        help='threads per worker (default: %(default)s)')
+    parser.add_argument('--timeout', type=int, default=30,
+                        help='seconds before a hung worker is restarted')
+    parser.add_argument('--graceful-timeout', type=int, default=30,
+                        help='seconds workers get to finish on a restart')
+    parser.add_argument('--access-log', default=None,
+                        help="access log file, '-' for stdout")
+    args = parser.parse_args()
+
+    if BaseApplication is object:
+        parser.error('gunicorn is not installed: pip install gunicorn')
+    if not env('CATALOG_SECRET_KEY'):
+        parser.error('set CATALOG_SECRET_KEY, shared by all workers')
+    config = {'SECRET_KEY': env('CATALOG_SECRET_KEY')}
+    # Every thread of a worker should be able to hold a connection.
+    config['DB_POOL_SIZE'] = max(int(env('CATALOG_DB_POOL_SIZE', 10)),
+                                 args.threads)
+    options = {
+        'bind': args.bind,
+        'workers': args.workers,
+        'threads': args.threads,
+        'worker_class': 'gthread' if args.threads > 1 else 'sync',
+        'timeout': args.timeout,
+        'graceful_timeout': args.graceful_timeout,
+        'preload_app': False,
+        'accesslog': args.access_log,
+    }
+    CatalogServer(options, config).run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
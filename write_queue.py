@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+"""
+This module commits the item writes of Item Catalog Application in groups.
+
+With SQLite only one connection can write at a time and every commit waits
+for the disk, so concurrent requests that each commit their own write queue
+up on the write lock. WriteQueue hands the writes to a single writer thread
+instead. Request threads submit a mutation, a function of a database session,
+and wait on the returned WriteFuture. The writer applies every mutation that
+is waiting in one session and commits them together, so one commit covers a
+whole burst of writes.
+
+Mutations may run more than once: when one of them raises, the batch is
+rolled back, the mutation's future gets the exception and the rest of the
+batch is applied again without it. Mutations must therefore only read and
+write through the session they are given, and return plain values rather
+than objects of that session.
+"""
+
+import os
+import threading
+import time
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+class WriteTimeout(RuntimeError):
+    """WriteTimeout is raised when a write is not done within the timeout."""
+
+
+class WriteFuture(object):
+    """WriteFuture holds the outcome of a submitted mutation."""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+
+    def setResult(self, result):
+        """Complete the future with the mutation's return value."""
+        self._result = result
+        self._done.set()
+
+    def setError(self, error):
+        """Complete the future with the exception raised for the mutation."""
+        self._error = error
+        self._done.set()
+
+    def result(self, timeout=None):
+        """
+        result waits until the mutation is committed or has failed.
+
+        args:
+        timeout - seconds to wait, or None to wait until it is done.
+
+        returns:
+        the return value of the mutation. Its exception, or the exception of
+        the commit, is raised instead if it failed. WriteTimeout is raised if
+        it is not done in time; the mutation may still be committed later.
+        """
+        if not self._done.wait(timeout):
+            raise WriteTimeout('The write did not finish in time.')
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+class WriteQueue(object):
+    """WriteQueue applies mutations from one writer thread in batches."""
+
+    def __init__(self, sessionFactory, maxBatch=100, maxDelay=0.0):
+        """
+        args:
+        sessionFactory - sessionmaker creating the writer's sessions.
+        maxBatch - most mutations committed together.
+        maxDelay - seconds the writer waits for more mutations before it
+                   commits a batch that is not full.
+        """
+        self.sessionFactory = sessionFactory
+        self.maxBatch = maxBatch
+        self.maxDelay = maxDelay
+        self.batches = 0
+        self.mutations = 0
+        self.failures = 0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def submit(self, mutation):
+        """
+        submit queues a mutation for the writer thread.
+
+        args:
+        mutation - function taking a database session and returning a plain
+                   value. It must not commit.
+
+        returns:
+        WriteFuture of the mutation.
+        """
+        self._ensureWriter()
+        future = WriteFuture()
+        self._queue.put((mutation, future))
+        return future
+
+    def _ensureWriter(self):
+        """Start the writer thread, again in a forked worker process."""
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run,
+                                            name='catalog-writer')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """Commit the queued mutations and stop the writer thread."""
+        with self._lock:
+            thread = self._thread
+            if thread is None or self._pid != os.getpid():
+                return
+            self._queue.put(None)
+            self._thread = None
+            self._pid = None
+        thread.join()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            entry = self._queue.get()
+            if entry is None:
+                return
+            batch = [entry]
+            deadline = time.time() + self.maxDelay
+            while len(batch) < self.maxBatch:
+                try:
+                    wait = deadline - time.time()
+                    if wait > 0:
+                        entry = self._queue.get(timeout=wait)
+                    else:
+                        entry = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if entry is None:
+                    stopping = True
+                    break
+                batch.append(entry)
+            self._commitBatch(batch)
+
+    def _commitBatch(self, batch):
+        """Apply and commit a batch, leaving out mutations that raise."""
+        pending = list(batch)
+        while pending:
+            session = self.sessionFactory()
+            results = []
+            failed = None
+            try:
+                for index, (mutation, future) in enumerate(pending):
+                    try:
+                        results.append(mutation(session))
+                    except Exception as error:
+                        failed = (index, error)
+                        break
+                if failed is None:
+                    session.commit()
+            except Exception as error:
+                session.rollback()
+                self._finish(pending, error=error)
+                return
+            finally:
+                if failed is not None:
+                    session.rollback()
+                session.close()
+            if failed is None:
+                self._finish(pending, results=results)
+                return
+            index, error = failed
+            self._finish([pending.pop(index)], error=error)
+
+    def _finish(self, entries, results=None, error=None):
+        """Complete the futures of entries and update the counters."""
+        with self._lock:
+            if results is not None:
+                self.batches += 1
+                self.mutations += len(entries)
+            else:
+                self.failures += len(entries)
+        for index, (mutation, future) in enumerate(entries):
+            if results is not None:
+                future.setResult(results[index])
+            else:
+                future.setError(error)
+
+    @property
+    def stats(self):
+        """Return the queue counters in easily serializeable format."""
+        return {
+            'queued': self._queue.qsize(),
+            'batches': self.batches,
+            'mutations': self.mutations,
+            'failures': self.failures
+        }